@@ -0,0 +1,78 @@
+#####################################
+# Benchmark disaggregation matching on synthetic catalogs, sites and disaggregation
+# (asv: asv run, or directly: python benchmarks/run.py disaggregation)
+import os
+import sys
+import tempfile
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import disaggregation_oq_sources as dos
+import synthetic
+
+#hazard level of the synthetic disaggregation
+POE = 0.1
+
+class MatchDisaggregation(object):
+    params = [synthetic.EVENTS,synthetic.SITES]
+    param_names = ['events','sites']
+    timeout = 600
+
+    def setup(self,n,nsites):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        sites_filename,disagg_filename = synthetic.write_disaggregation(self.tmpdir.name,nsites)
+        self.ruptures = synthetic.synthetic_catalog(n)
+        #as read by connect (binned ruptures are memoized)
+        self.ruptures.attrs['version'] = ('synthetic',n)
+        self.repository = dos.DisaggregationRepository(disagg_filename,sites_filename)
+        sites = self.repository.get_sites()
+        self.target = (sites.lat.values[0],sites.lon.values[0])
+        #load files and bins of target
+        dos.match_disaggregation(self.ruptures,self.target[0],self.target[1],POE,repository=self.repository)
+
+    def teardown(self,n,nsites):
+        self.tmpdir.cleanup()
+
+    def time_match_disaggregation(self,n,nsites):
+        dos.match_disaggregation(self.ruptures,self.target[0],self.target[1],POE,repository=self.repository)
+
+    def peakmem_match_disaggregation(self,n,nsites):
+        dos.match_disaggregation(self.ruptures,self.target[0],self.target[1],POE,repository=self.repository)
+
+    def time_match_disaggregation_realizations(self,n,nsites):
+        dos.match_disaggregation_realizations(self.ruptures,self.target[0],self.target[1],POE,realizations=10,repository=self.repository)
+
+    def time_binning(self,n,nsites):
+        dos.group_bins(dos.bin_keys(self.ruptures.longitude.values,self.ruptures.latitude.values,self.ruptures.magnitude.values,0.2,0.2,0.5),self.ruptures.index.values)
+
+class Sites(object):
+    params = [synthetic.SITES]
+    param_names = ['sites']
+
+    def setup(self,nsites):
+        self.sites = synthetic.synthetic_sites(nsites)
+        self.index = dos.SiteIndex(self.sites)
+
+    def time_site_index(self,nsites):
+        dos.SiteIndex(self.sites)
+
+    def time_nearest(self,nsites):
+        self.index.nearest(-71.5,-33.1)
+
+class DisaggregationFiles(object):
+    params = [synthetic.SITES]
+    param_names = ['sites']
+    timeout = 600
+
+    def setup(self,nsites):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.sites_filename,self.disagg_filename = synthetic.write_disaggregation(self.tmpdir.name,nsites)
+
+    def teardown(self,nsites):
+        self.tmpdir.cleanup()
+
+    def time_load_bins(self,nsites):
+        dos.DisaggregationRepository(self.disagg_filename,self.sites_filename).get_bins(0,POE)
+
+    def peakmem_load_bins(self,nsites):
+        dos.DisaggregationRepository(self.disagg_filename,self.sites_filename).get_bins(0,POE)
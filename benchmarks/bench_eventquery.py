@@ -0,0 +1,173 @@
+#####################################
+# Benchmark event queries of each type on synthetic catalogs
+# (asv: asv run, or directly: python benchmarks/run.py eventquery)
+# checks of the query results: python benchmarks/bench_eventquery.py
+import os
+import sys
+import tempfile
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import eventquery
+import eventstore
+import eventformats
+import synthetic
+
+#example target (site 0 of sites.csv) and deaggregation hazard level
+QUERY = {'lonmin':-73.,'lonmax':-70.,'latmin':-35.,'latmax':-31.,'mmin':6.,'mmax':8.5,'zmin':5,'zmax':140,
+         'tlon':-71.5730623712764,'tlat':-33.1299174879672}
+PROBABILITY = {'stochastic':0.5,'observed':0,'expert':0,'deaggregation':0.1}
+
+def query(etype):
+    '''
+    returns keyword arguments of query_events for type
+    '''
+    return dict(QUERY,etype=etype,p=PROBABILITY[etype])
+
+class EventQuery(object):
+    '''
+    in-memory catalog (as connect(storage='csv'))
+    '''
+    params = [synthetic.EVENTS,['stochastic','observed','expert','deaggregation']]
+    param_names = ['events','etype']
+    timeout = 600
+
+    def setup(self,n,etype):
+        self.db = synthetic.synthetic_catalog(n)
+        #as read by connect (binned ruptures of deaggregation are memoized)
+        self.db.attrs['version'] = ('synthetic',n)
+        self.kwargs = query(etype)
+
+    def time_select_events(self,n,etype):
+        eventquery.select_events(self.db,**self.kwargs)
+
+    def time_query_events(self,n,etype):
+        eventquery.query_events(self.db,**self.kwargs)
+
+    def time_query_events_top(self,n,etype):
+        eventquery.query_events(self.db,num_events=100,**self.kwargs)
+
+    def peakmem_query_events(self,n,etype):
+        eventquery.query_events(self.db,**self.kwargs)
+
+class StoreQuery(object):
+    '''
+    catalog in a store (as connect(storage='sqlite'/'mmap'))
+    '''
+    params = [synthetic.EVENTS,['sqlite','mmap'],['stochastic','deaggregation']]
+    param_names = ['events','storage','etype']
+    timeout = 600
+
+    def setup(self,n,storage,etype):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        catalog = synthetic.synthetic_catalog(n)
+        if storage == 'sqlite':
+            self.db = eventstore.EventStore(os.path.join(self.tmpdir.name,'catalog.sqlite'))
+            self.db.insert(catalog)
+            self.db.create_index()
+        else:
+            self.db = eventstore.export_mapped(catalog,os.path.join(self.tmpdir.name,'catalog.npy'))
+        self.kwargs = query(etype)
+
+    def teardown(self,n,storage,etype):
+        if storage == 'sqlite':
+            self.db.close()
+        self.tmpdir.cleanup()
+
+    def time_query_events(self,n,storage,etype):
+        eventquery.query_events(self.db,**self.kwargs)
+
+    def time_query_events_top(self,n,storage,etype):
+        eventquery.query_events(self.db,num_events=100,**self.kwargs)
+
+    def peakmem_query_events(self,n,storage,etype):
+        eventquery.query_events(self.db,**self.kwargs)
+
+#radius (km) around the target and time windows
+WINDOWS = {'radius':{'radius':100.},'time':{'tmin':'1990-01-01','tmax':'2000-01-01'},
+           'radius+time':{'radius':100.,'tmin':'1990-01-01','tmax':'2000-01-01'}}
+
+class RadiusTimeQuery(object):
+    '''
+    observed events within radius of the target and/or time window
+    '''
+    params = [synthetic.EVENTS,list(WINDOWS)]
+    param_names = ['events','window']
+    timeout = 600
+
+    def setup(self,n,window):
+        self.db = synthetic.synthetic_catalog(n)
+        #as read by connect (index is memoized)
+        self.db.attrs['version'] = ('synthetic',n)
+        self.kwargs = dict(query('observed'),**WINDOWS[window])
+        eventquery.select_events(self.db,**self.kwargs)
+
+    def time_select_events(self,n,window):
+        eventquery.select_events(self.db,**self.kwargs)
+
+    def time_filter_events(self,n,window):
+        #without index
+        selected = eventquery.filter_time(self.db,self.kwargs.get('tmin'),self.kwargs.get('tmax'))
+        if 'radius' in self.kwargs:
+            selected = eventquery.filter_radius(selected,self.kwargs['tlat'],self.kwargs['tlon'],self.kwargs['radius'])
+
+#events of a feed (half of them known, half new)
+FEED_EVENTS = 100
+
+class Upsert(object):
+    '''
+    adding a feed of events to an in-memory catalog or a store
+    '''
+    params = [synthetic.EVENTS,['csv','sqlite']]
+    param_names = ['events','storage']
+    timeout = 600
+
+    def setup(self,n,storage):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        catalog = synthetic.synthetic_catalog(n+FEED_EVENTS//2)
+        self.feed = catalog.iloc[-FEED_EVENTS:].copy()
+        self.feed['magnitude'] += 0.1
+        catalog = catalog.iloc[:n]
+        if storage == 'sqlite':
+            self.db = eventstore.EventStore(os.path.join(self.tmpdir.name,'catalog.sqlite'))
+            self.db.insert(catalog)
+            self.db.create_index()
+        else:
+            self.db = catalog
+            self.db.attrs['version'] = ('synthetic',n)
+
+    def teardown(self,n,storage):
+        if storage == 'sqlite':
+            self.db.close()
+        self.tmpdir.cleanup()
+
+    def time_upsert_events(self,n,storage):
+        eventquery.upsert_events(self.db,self.feed)
+
+    def peakmem_upsert_events(self,n,storage):
+        eventquery.upsert_events(self.db,self.feed)
+
+def check_compact(n=10000):
+    '''
+    compact catalogs (connect(compact=True)) return the same results
+    as plain catalogs in every output format
+    '''
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir,'catalog.csv')
+        synthetic.synthetic_catalog(n).to_csv(filename,index=False)
+        plain = eventquery.read_database(filename)
+        compact = eventquery.read_database(filename,compact=True)
+    for etype in ['stochastic','observed','expert']:
+        for output_format in eventformats.FORMATS:
+            if output_format in ['arrow','parquet'] and eventformats.pyarrow is None:
+                continue
+            for kwargs in [query(etype),{'etype':etype,'p':PROBABILITY[etype]}]:
+                kwargs = dict(kwargs,output_format=output_format)
+                assert eventquery.query_events(plain,**kwargs) == eventquery.query_events(compact,**kwargs), (etype,output_format)
+
+def main():
+    check_compact()
+    print('ok')
+
+if __name__ =='__main__':
+    main()
@@ -0,0 +1,127 @@
+#####################################
+# Benchmark QuakeML serialization, parsing and round trip
+# and the other output formats
+# (asv: asv run, or directly: python benchmarks/run.py quakeml)
+# checks of the serializers: python benchmarks/bench_quakeml.py
+import os
+import sys
+import tempfile
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import quakeml
+import eventformats
+import synthetic
+
+#the lxml tree serializer is too slow for larger catalogs
+TREE_MAX_EVENTS = 100000
+
+class QuakeMLSerialization(object):
+    params = synthetic.EVENTS
+    param_names = ['events']
+    timeout = 600
+
+    def setup(self,n):
+        self.catalog = synthetic.synthetic_catalog(n)
+
+    def time_events2quakeml_bulk(self,n):
+        quakeml.events2quakeml_bulk(self.catalog)
+
+    def peakmem_events2quakeml_bulk(self,n):
+        quakeml.events2quakeml_bulk(self.catalog)
+
+    def time_iter_quakeml(self,n):
+        for chunk in quakeml.iter_quakeml(self.catalog):
+            pass
+
+class QuakeMLTreeSerialization(object):
+    '''
+    lxml tree serializer (reference of the bulk serializer)
+    '''
+    params = synthetic.EVENTS
+    param_names = ['events']
+    timeout = 600
+
+    def setup(self,n):
+        if n > TREE_MAX_EVENTS:
+            #skipped (asv skips benchmarks raising NotImplementedError in setup)
+            raise NotImplementedError('too slow for more than {} events'.format(TREE_MAX_EVENTS))
+        self.catalog = synthetic.synthetic_catalog(n)
+
+    def time_events2quakeml(self,n):
+        quakeml.events2quakeml(self.catalog)
+
+class QuakeMLParsing(object):
+    params = synthetic.EVENTS
+    param_names = ['events']
+    timeout = 600
+
+    def setup(self,n):
+        self.catalog = synthetic.synthetic_catalog(n)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmpdir.name,'events.xml')
+        with open(self.filename,'w') as f:
+            quakeml.events2quakeml_bulk(self.catalog,stream=f)
+
+    def teardown(self,n):
+        self.tmpdir.cleanup()
+
+    def time_quakeml2events(self,n):
+        quakeml.quakeml2events(self.filename)
+
+    def peakmem_quakeml2events(self,n):
+        quakeml.quakeml2events(self.filename)
+
+    def time_read_quakeml_chunked(self,n):
+        for chunk in quakeml.read_quakeml(self.filename,chunksize=10000):
+            pass
+
+    def peakmem_read_quakeml_chunked(self,n):
+        for chunk in quakeml.read_quakeml(self.filename,chunksize=10000):
+            pass
+
+    def time_round_trip(self,n):
+        quakeml.quakeml2events(quakeml.events2quakeml_bulk(self.catalog))
+
+class OutputFormats(object):
+    params = [synthetic.EVENTS,list(eventformats.FORMATS),[None,'gzip']]
+    param_names = ['events','output_format','compression']
+    timeout = 600
+
+    def setup(self,n,output_format,compression):
+        if output_format in ['arrow','parquet'] and eventformats.pyarrow is None:
+            raise NotImplementedError('requires pyarrow')
+        self.catalog = synthetic.synthetic_catalog(n)
+
+    def time_encode_events(self,n,output_format,compression):
+        eventformats.encode_events(self.catalog,output_format,compression)
+
+    def peakmem_encode_events(self,n,output_format,compression):
+        eventformats.encode_events(self.catalog,output_format,compression)
+
+    def track_size(self,n,output_format,compression):
+        return len(eventformats.encode_events(self.catalog,output_format,compression))
+    track_size.unit = 'bytes'
+
+def check_bulk(n=1000):
+    '''
+    the bulk serializer (used by query_events) returns the same QuakeML as the
+    lxml tree serializer, including escaped text and empty catalogs
+    '''
+    catalog = synthetic.synthetic_catalog(n)
+    assert quakeml.events2quakeml(catalog) == quakeml.events2quakeml_bulk(catalog)
+    escaped = catalog.iloc[:10].copy()
+    escaped['eventID'] = ['syn{}&<>"\''.format(i) for i in range(len(escaped))]
+    escaped['Agency'] = 'GFZ & <Partner>'
+    assert quakeml.events2quakeml(escaped) == quakeml.events2quakeml_bulk(escaped)
+    assert quakeml.events2quakeml(escaped,provider='A&B') == quakeml.events2quakeml_bulk(escaped,provider='A&B')
+    empty = catalog.iloc[:0]
+    assert quakeml.events2quakeml(empty) == quakeml.events2quakeml_bulk(empty)
+    assert ''.join(quakeml.iter_quakeml(catalog,chunksize=100)) == quakeml.events2quakeml_bulk(catalog)
+
+def main():
+    check_bulk()
+    print('ok')
+
+if __name__ =='__main__':
+    main()
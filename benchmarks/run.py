@@ -0,0 +1,126 @@
+#####################################
+# Runs the benchmarks without asv: wall time (best of repeats) and
+# peak memory allocated (tracemalloc) of each benchmark,
+# results can be saved and compared against a previous run
+# e.g. BENCH_EVENTS=1e3,1e5 python benchmarks/run.py quakeml eventquery --output base.json
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import importlib
+import tracemalloc
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['quakeml','eventquery','disaggregation']
+
+def benchmarks(module):
+    '''
+    yields (name,class,method names) of the benchmark classes of module
+    '''
+    for name in sorted(dir(module)):
+        cls = getattr(module,name)
+        if isinstance(cls,type) and cls.__module__ == module.__name__:
+            methods = [m for m in sorted(dir(cls)) if m.startswith('time_') or m.startswith('peakmem_')]
+            if methods:
+                yield name,cls,methods
+
+def parameters(cls):
+    '''
+    returns all combinations of the (asv style) parameters of benchmark class
+    '''
+    params = getattr(cls,'params',[])
+    if not params:
+        return [()]
+    if not isinstance(params[0],list):
+        params = [params]
+    return list(itertools.product(*params))
+
+def measure(method,args,repeat):
+    '''
+    returns best wall time (s) of repeat calls and peak memory (bytes) allocated by one call
+    '''
+    tracemalloc.start()
+    method(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        method(*args)
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best,elapsed)
+    return best,peak
+
+def run(names,repeat=3,match=None):
+    '''
+    runs benchmarks of modules (bench_<name>.py), returns results
+    {benchmark (with parameters): {'time':s,'peakmem':bytes}}
+    '''
+    results = {}
+    for name in names:
+        module = importlib.import_module('bench_'+name)
+        for cls_name,cls,methods in benchmarks(module):
+            for args in parameters(cls):
+                bench = cls()
+                try:
+                    if hasattr(bench,'setup'):
+                        bench.setup(*args)
+                except NotImplementedError:
+                    continue
+                try:
+                    for method in methods:
+                        key = '{}.{}.{}({})'.format(name,cls_name,method,','.join(str(a) for a in args))
+                        if match is not None and match not in key:
+                            continue
+                        try:
+                            #peakmem_ methods are timed as well (same call)
+                            elapsed,peak = measure(getattr(bench,method),args,repeat)
+                        except NotImplementedError:
+                            continue
+                        results[key] = {'time':elapsed,'peakmem':peak}
+                        print('{:<90s} {:10.4f}s {:10.1f}MB'.format(key,elapsed,peak/2**20))
+                        sys.stdout.flush()
+                finally:
+                    if hasattr(bench,'teardown'):
+                        bench.teardown(*args)
+    return results
+
+def compare(results,baseline,factor=1.5):
+    '''
+    returns benchmarks slower or using more memory than factor times the baseline
+    '''
+    regressions = []
+    for key,result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for measure_name in ['time','peakmem']:
+            if result[measure_name] > factor*baseline[key][measure_name]:
+                regressions.append((key,measure_name,baseline[key][measure_name],result[measure_name]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs benchmarks (sizes: BENCH_EVENTS, BENCH_SITES)')
+    parser.add_argument('modules',nargs='*',default=MODULES,help='benchmark modules ({})'.format(', '.join(MODULES)))
+    parser.add_argument('--repeat',type=int,default=3,help='timed calls per benchmark (best is reported)')
+    parser.add_argument('--match',help='runs only benchmarks containing this string')
+    parser.add_argument('--output',help='saves results as json')
+    parser.add_argument('--compare',help='results (json) of a previous run, fails on regressions')
+    parser.add_argument('--factor',type=float,default=1.5,help='tolerated slowdown/memory increase for --compare')
+    args = parser.parse_args()
+    results = run(args.modules,args.repeat,args.match)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1,sort_keys=True)
+    if args.compare:
+        with open(args.compare,'r') as f:
+            regressions = compare(results,json.load(f),args.factor)
+        for key,measure_name,before,after in regressions:
+            print('REGRESSION {} {}: {:.4g} -> {:.4g}'.format(key,measure_name,before,after))
+        if regressions:
+            sys.exit(1)
+
+if __name__ =='__main__':
+    main()
@@ -0,0 +1,118 @@
+#####################################
+# Synthetic stochastic catalogs, sites and disaggregation
+# for benchmarks (layouts as eventquery, sites.csv and mean_disagg.csv)
+import os
+import argparse
+import numpy as np
+import pandas
+
+COLUMNS=['eventID', 'Agency', 'Identifier', 'year', 'month', 'day', 'hour', 'minute', 'second', 'timeUncertainty', 'longitude', 'longitudeUncertainty', 'latitude', 'latitudeUncertainty','horizontalUncertainty','maxHorizontalUncertainty', 'minHorizontalUncertainty', 'azimuthMaxHorizontalUncertainty', 'depth', 'depthUncertainty', 'magnitude', 'magnitudeUncertainty','rake','rakeUncertainty','dip','dipUncertainty','strike','strikeUncertainty','type', 'probability']
+#region (lonmin,lonmax,latmin,latmax) around the example site (Valparaiso)
+REGION = (-75.,-68.,-36.,-30.)
+
+def sizes(name,default):
+    '''
+    returns benchmark sizes from environment variable name (comma separated,
+    e.g. BENCH_EVENTS=1e3,1e5,1e7) or default
+    '''
+    value = os.environ.get(name)
+    if not value:
+        return list(default)
+    return [int(float(v)) for v in value.split(',')]
+
+#benchmarked numbers of events and sites (up to 1e7 events and 1e4 sites
+#with e.g. BENCH_EVENTS=1e3,1e5,1e7 BENCH_SITES=1,1e2,1e4)
+EVENTS = sizes('BENCH_EVENTS',[1000,10000,100000])
+SITES = sizes('BENCH_SITES',[1,100,1000])
+
+def synthetic_catalog(n,seed=42,region=REGION,types=(('stochastic',0.9),('observed',0.08),('expert',0.02))):
+    '''
+    returns catalog with n random events in region (types drawn with given fractions),
+    locations and magnitudes of stochastic events are on a 0.001 deg / 0.1 Mw grid
+    '''
+    rng = np.random.default_rng(seed)
+    catalog = pandas.DataFrame(index=range(n),columns=COLUMNS)
+    catalog['eventID'] = ['syn{}'.format(i) for i in range(n)]
+    catalog['Agency'] = 'GFZ'
+    catalog['year'] = rng.integers(1700,2018,n)
+    catalog['month'] = rng.integers(1,13,n)
+    catalog['day'] = rng.integers(1,29,n)
+    catalog['hour'] = rng.integers(0,24,n)
+    catalog['minute'] = rng.integers(0,60,n)
+    catalog['second'] = rng.uniform(0,60,n).round(2)
+    catalog['longitude'] = rng.uniform(region[0],region[1],n).round(3)
+    catalog['latitude'] = rng.uniform(region[2],region[3],n).round(3)
+    catalog['depth'] = rng.uniform(0,150,n).round(1)
+    #Gutenberg-Richter (b=1) between Mw 5 and 9
+    catalog['magnitude'] = np.minimum(5+rng.exponential(1/np.log(10),n),9).round(1)
+    catalog['magnitudeUncertainty'] = 0.2
+    names,fractions = zip(*types)
+    catalog['type'] = rng.choice(names,n,p=np.array(fractions)/sum(fractions))
+    catalog['probability'] = rng.uniform(0,1,n)
+    return catalog
+
+def synthetic_sites(n,seed=42,region=REGION):
+    '''
+    returns n random sites (sid,lon,lat) in region
+    '''
+    rng = np.random.default_rng(seed)
+    return pandas.DataFrame({'sid':np.arange(n),
+                             'lon':rng.uniform(region[0],region[1],n),
+                             'lat':rng.uniform(region[2],region[3],n)})
+
+def synthetic_disaggregation(sites,poes=(0.1,),seed=42,radius=1.,step=0.2,mstep=0.5,nonzero=0.1):
+    '''
+    returns disaggregation (sid,poe50y,Lon,Lat,Mag,poe) with bins of step (deg) within
+    radius (deg) around each site and magnitude bins of mstep from Mw 5 to 9,
+    fraction nonzero of the bins has non-zero poe
+    '''
+    rng = np.random.default_rng(seed)
+    offsets = np.arange(-radius,radius+step/2,step)
+    mags = np.arange(5,9+mstep/2,mstep)
+    dlon,dlat,mag = [a.ravel() for a in np.meshgrid(offsets,offsets,mags,indexing='ij')]
+    nbins = len(dlon)
+    tables = []
+    for poe50y in poes:
+        nsites = len(sites)
+        #bins centered on site rounded to grid
+        lon = (np.repeat(np.round(sites.lon.values/step)*step,nbins)+np.tile(dlon,nsites)).round(5)
+        lat = (np.repeat(np.round(sites.lat.values/step)*step,nbins)+np.tile(dlat,nsites)).round(5)
+        poe = np.where(rng.uniform(0,1,nsites*nbins) < nonzero,rng.exponential(1e-3,nsites*nbins),0.)
+        tables.append(pandas.DataFrame({'sid':np.repeat(sites.sid.values,nbins),'poe50y':poe50y,
+                                        'Lon':lon,'Lat':lat,'Mag':np.tile(mag,nsites),'poe':poe}))
+    return pandas.concat(tables,ignore_index=True)
+
+def write_disaggregation(directory,sites,seed=42):
+    '''
+    writes sites.csv and mean_disagg.csv with sites (number) to directory,
+    returns their file names
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    filenames = [os.path.join(directory,f) for f in ['sites.csv','mean_disagg.csv']]
+    s = synthetic_sites(sites,seed)
+    s.to_csv(filenames[0],index=False)
+    synthetic_disaggregation(s,seed=seed).to_csv(filenames[1],index=False)
+    return filenames
+
+def write_synthetic(directory,events,sites,seed=42):
+    '''
+    writes catalog.csv, sites.csv and mean_disagg.csv to directory,
+    returns their file names
+    '''
+    filenames = write_disaggregation(directory,sites,seed)
+    catalog_filename = os.path.join(directory,'catalog.csv')
+    synthetic_catalog(events,seed).to_csv(catalog_filename,index=False)
+    return [catalog_filename]+filenames
+
+def main():
+    parser = argparse.ArgumentParser(description='Writes synthetic catalog, sites and disaggregation')
+    parser.add_argument('directory')
+    parser.add_argument('--events',type=float,default=1e5,help='number of events (e.g. 1e7)')
+    parser.add_argument('--sites',type=float,default=10,help='number of sites (e.g. 1e4)')
+    parser.add_argument('--seed',type=int,default=42)
+    args = parser.parse_args()
+    write_synthetic(args.directory,int(args.events),int(args.sites),args.seed)
+
+if __name__ =='__main__':
+    main()
@@ -2,9 +2,24 @@
 #(processed using the /home/mhaas/RIESGOS/disaggregation/createPlot.py routine)
 #returns the stochastic set of events associated with the poe of the disaggregation bin it belongs to
 import os
+import sys
+import argparse
+import collections
+import threading
+import concurrent.futures
 import pandas
 import numpy as np
-#import scipy
+#from . import eventstore
+import eventstore
+#from . import querytrace
+import querytrace
+#from . import eventindex
+import eventindex
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    #fall back to (vectorized) brute force search
+    cKDTree = None
 #import time
 
 #t0=time.time()
@@ -43,161 +58,491 @@ def oqrup2cat(ruptures,dtype='deaggregation',provider='GFZ'):
     Converts a set of OQ ruptures to a catalog
     '''
     #initialize
-    index = [i for i in range(len(ruptures))]
+    n = len(ruptures)
     columns=['eventID', 'Agency', 'Identifier', 'year', 'month', 'day', 'hour', 'minute', 'second', 'timeError', 'longitude', 'latitude','SemiMajor90', 'SemiMinor90', 'ErrorStrike', 'depth', 'depthError', 'magnitude', 'sigmaMagnitude','rake','dip','strike','type', 'probability', 'fuzzy']
-    catalog=pandas.DataFrame(index=index,columns=columns)
-    #add values
-    catalog.eventID   = ruptures.rupid
-    catalog.Agency    = provider
-    catalog.longitude = ruptures.centroid_lon
-    catalog.latitude  = ruptures.centroid_lat
-    catalog.depth     = ruptures.centroid_depth
-    catalog.magnitude = ruptures.mag
-    catalog.type      = dtype
+    catalog=pandas.DataFrame(index=range(n),columns=columns)
+    #add values (by position, ruptures may be a chunk with any index)
+    catalog['eventID']   = ruptures.rupid.values
+    catalog['Agency']    = provider
+    catalog['longitude'] = ruptures.centroid_lon.values
+    catalog['latitude']  = ruptures.centroid_lat.values
+    catalog['depth']     = ruptures.centroid_depth.values
+    catalog['magnitude'] = ruptures.mag.values
+    catalog['type']      = dtype
     #not necessarily defined
-    try:
-        catalog.strike    = ruptures.strike
-    except:
-        pass
-    try:
-        catalog.dip       = ruptures.dip
-    except:
-        pass
-    try:
-        catalog.rake      = ruptures.rake
-    except:
-        pass
-    try:
-        catalog.probability = ruptures.poe
-    except:
-        pass
+    for column,oqcolumn in [('strike','strike'),('dip','dip'),('rake','rake'),('probability','poe')]:
+        if oqcolumn in ruptures.columns:
+            catalog[column] = ruptures[oqcolumn].values
 
     return catalog
 
-def binning_xyz(data,px,py,pz):
+def ingest_ruptures(filenames,store,dtype='stochastic',provider='GFZ',chunksize=100000,progress=None,skiprows=1,delimiter='\t'):
     '''
-    given pandas data frame (data x,y,z) and bins dy,dy,dz
-    returns binned data
+    Reads OQ rupture exports (e.g., ruptures_*.csv) in chunks, converts them to
+    catalog style and appends them to store (eventstore.EventStore)
+    progress (callable) is called with the number of ruptures written so far
+    returns number of ruptures written
     '''
-    xyz=data.copy()
-    cols=xyz.columns
-    #rounds to bin precision
-    xyz[cols[0]] = xyz[cols[0]]/px
-    xyz[cols[1]] = xyz[cols[1]]/py
-    xyz[cols[2]] = xyz[cols[2]]/pz
-    xyz = xyz.round()
-    xyz[cols[0]] = xyz[cols[0]]*px
-    xyz[cols[1]] = xyz[cols[1]]*py
-    xyz[cols[2]] = xyz[cols[2]]*pz
-    return xyz
+    #NOTE: runs in one process, parsing and conversion are a small fraction of
+    #      the time, the store writes (insert and index) dominate and are serial
+    if isinstance(filenames,str):
+        filenames = [filenames]
+    written = 0
+    for filename in filenames:
+        for ruptures in pandas.read_csv(filename,skiprows=skiprows,delimiter=delimiter,chunksize=chunksize):
+            catalog = oqrup2cat(ruptures,dtype,provider)
+            store.insert(catalog)
+            written += len(catalog)
+            if progress is not None:
+                progress(written)
+    store.create_index()
+    return written
+
+#bin index of missing values
+INVALID_BIN = np.iinfo('int32').min
+
+def bin_keys(x,y,z,px,py,pz,out=None):
+    '''
+    given arrays x,y,z and bins px,py,pz returns integer bin index (int32, shape (3,n)),
+    written into out if given (missing values: INVALID_BIN)
+    '''
+    n = len(x)
+    if out is None:
+        out = np.empty((3,n),dtype='int32')
+    buf = np.empty(n,dtype='float64')
+    for j,(values,p) in enumerate([(x,px),(y,py),(z,pz)]):
+        np.divide(values,p,out=buf)
+        np.rint(buf,out=buf)
+        buf[~np.isfinite(buf)] = INVALID_BIN
+        out[j] = buf
+    return out
+
+def group_bins(keys,index):
+    '''
+    given bin index (3,n) of events and their index labels returns
+    events sorted by bin with the (x,y,z,count,start) of each bin
+    '''
+    valid = np.flatnonzero((keys!=INVALID_BIN).all(axis=0))
+    #events sorted by bin, each bin is a contiguous block (start,count)
+    order = valid[np.lexsort((keys[2,valid],keys[1,valid],keys[0,valid]))]
+    sorted_keys = pandas.DataFrame({'x':keys[0,order],'y':keys[1,order],'z':keys[2,order]})
+    groups = sorted_keys.groupby(['x','y','z'],sort=False).size().rename('count').reset_index()
+    groups['start'] = np.concatenate([[0],np.cumsum(groups['count'].values)[:-1]]).astype('int64')
+    return {'index':np.asarray(index),'order':order,'groups':groups}
+
+#binned ruptures per (catalog version, precision)
+BINNED_MAXSIZE = 8
+_binned = collections.OrderedDict()
+_binned_lock = threading.Lock()
+
+def get_binned(ruptures,px,py,pz):
+    '''
+    returns ruptures grouped by bin (see group_bins), memoized per catalog version
+    (attrs['version'] of the ruptures dataframe) and precision
+    ruptures can also be a mapped catalog (eventstore.MappedCatalog): its stochastic
+    events are binned on the mapped columns (labels are positions), no rows are copied
+    '''
+    mapped = not isinstance(ruptures,pandas.DataFrame)
+    key = None
+    if mapped:
+        key = ('mapped',ruptures.directory,ruptures.version,px,py,pz)
+    elif ruptures.attrs.get('version') is not None and len(ruptures)>0:
+        key = (ruptures.attrs['version'],len(ruptures),ruptures.index[0],ruptures.index[-1],px,py,pz)
+    if key is not None:
+        with _binned_lock:
+            if key in _binned:
+                _binned.move_to_end(key)
+                return _binned[key]
+    if mapped:
+        index = ruptures.positions('deaggregation',spatial=False)
+        columns = ruptures.columns
+        keys = bin_keys(columns['longitude'][index],columns['latitude'][index],columns['magnitude'][index],px,py,pz)
+    else:
+        index = ruptures.index.values
+        keys = bin_keys(ruptures.longitude.values,ruptures.latitude.values,ruptures.magnitude.values,px,py,pz)
+    binned = group_bins(keys,index)
+    if key is not None:
+        with _binned_lock:
+            _binned[key] = binned
+            while len(_binned) > BINNED_MAXSIZE:
+                _binned.popitem(last=False)
+    return binned
+
+def take_events(ruptures,idxs):
+    '''
+    returns events with index labels idxs of ruptures (dataframe or catalog store)
+    '''
+    if isinstance(ruptures,pandas.DataFrame):
+        return ruptures.loc[idxs]
+    return ruptures.take(idxs)
+
+def match_bins(binned,disagg,px,py,pz):
+    '''
+    returns disaggregation bins (Lon,Lat,Mag,poe) having events in binned events
+    (see group_bins) with poe and count/start of their events
+    '''
+    keys = bin_keys(disagg.Lon.values,disagg.Lat.values,disagg.Mag.values,px,py,pz)
+    bins = pandas.DataFrame({'x':keys[0],'y':keys[1],'z':keys[2],'poe':disagg.poe.values})
+    #join (keeps order of disaggregation bins)
+    return bins.merge(binned['groups'],on=['x','y','z'],how='inner')
 
 #FIXME: Add uncertainty here, i.e., calculate sigmas from all matching events/or just use half bins
-def return_random_event(events,disagg,seed=42):
-    '''
-    Per unique bin returns index of single random event and poe for corresponding disaggregation bin (which have assigned bins)
-    '''
-    idxs = []
-    poe = []
-    #go through bins of disaggregation
-    for i in range(len(disagg)):
-        seed+=i
-        row = disagg.iloc[i]
-        #get events
-        matches = events[(abs(events.longitude-row.Lon)<10**-5)&(abs(events.latitude-row.Lat)<10**-5)&(abs(events.magnitude-row.Mag)<10**-5)]
-        #append single random sampled idx
-        n=len(matches)
-        if n>0:
-            np.random.seed(seed)
-            idx=np.random.randint(0,n,1)[0]
-            idxs.append(matches.iloc[idx].name)
-            poe.append(row.poe)
-
-    return [idxs,poe]
-
-def match_disaggregation(ruptures,lat,lon,poe):
-    '''
-    Given a set of ruptures, a target with longitude/latitude,
-    and a target exceedance probability (e.g., 0.1 = 10%) for 50 years return period
-    picks up corresponding deaggregation and selects a single random event
-    from the rupture for each bin
+def sample_binned(binned,disagg,px,py,pz,seed=42):
+    '''
+    Per disaggregation bin (Lon,Lat,Mag,poe) returns index of single random event of
+    the binned events (see group_bins) and poe
     '''
-    #read deaggregation sites
-    filepath=os.path.dirname(__file__)
-    sites_filename = os.path.join(filepath,"sites.csv")
-    sites = pandas.read_csv(sites_filename)
-
-    #find closest match to target
-    slon= [sites.iloc[i].lon for i,v in enumerate(sites.lon) if abs(v-lon)==min(abs(sites.lon - lon))][0]
-    slon= [sites.iloc[i].lon for i,v in enumerate(sites.lon) if abs(v-lon)==min(abs(sites.lon - lon))][0]
-    slat= [sites.iloc[i].lat for i,v in enumerate(sites.lat) if abs(v-lat)==min(abs(sites.lat - lat))][0]
-    sid = int(sites[(sites.lon==slon) & (sites.lat==slat)].sid)
-    #get deaggregation
-    disagg_filename = os.path.join(filepath,"mean_disagg.csv")
-    dr = pandas.read_csv(disagg_filename)
-    #get that for specified hazard level and site
-    dr = dr[(dr.sid==sid) & (dr.poe50y==poe)]
-    #determine precision
-    plon = round(min(np.diff(dr.Lon.unique())),5)
-    plat = round(min(np.diff(dr.Lat.unique())),5)
-    pmag = round(min(np.diff(dr.Mag.unique())),5)
-    #bin the ruptures
-    bins = binning_xyz(ruptures[['longitude','latitude','magnitude']],plon,plat,pmag)
-    #take only those with non-zero poe
-    dr = dr[dr.poe>0]
+    matched = match_bins(binned,disagg,px,py,pz)
+    #single random event per bin
+    rng = np.random.default_rng(seed)
+    draw = rng.integers(0,matched['count'].values) if len(matched)>0 else np.zeros(0,dtype='int64')
+    idxs = binned['index'][binned['order'][matched.start.values+draw]]
 
-    #select events
-    idxs,poe = return_random_event(bins,dr,seed=42)
-    matches = ruptures.loc[idxs]
-    matches['probability']=poe
+    return [list(idxs),list(matched.poe.values)]
+
+def _draw_realizations(args):
+    '''
+    draws one event per bin (position within bin) for each seed of a block of realizations
+    '''
+    counts,seeds = args
+    return np.stack([np.random.default_rng(s).integers(0,counts) for s in seeds]) if len(seeds)>0 else np.zeros((0,len(counts)),dtype='int64')
+
+def sample_realizations(binned,disagg,px,py,pz,realizations=100,seed=42,processes=1):
+    '''
+    Draws realizations, each with a single random event per disaggregation bin
+    (Lon,Lat,Mag,poe) of the binned events (see group_bins)
+    Every realization has its own random stream (SeedSequence.spawn), so results are
+    reproducible and independent of order and number of processes
+    returns table with realization, event index and poe of the bin
+    '''
+    matched = match_bins(binned,disagg,px,py,pz)
+    counts = matched['count'].values
+    seeds = np.random.SeedSequence(seed).spawn(realizations)
+    #blocks of realizations
+    processes = max(1,processes or os.cpu_count() or 1)
+    nblock = max(1,-(-realizations//processes))
+    blocks = [(counts,seeds[i:i+nblock]) for i in range(0,realizations,nblock)]
+    if processes > 1 and len(blocks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+            draws = list(executor.map(_draw_realizations,blocks))
+    else:
+        draws = [_draw_realizations(b) for b in blocks]
+    draws = np.concatenate(draws) if draws else np.zeros((0,len(counts)),dtype='int64')
+    #stack realizations (realization x bin)
+    idxs = binned['index'][binned['order'][matched.start.values+draws]]
+    return pandas.DataFrame({'realization':np.repeat(np.arange(realizations),len(counts)),
+                             'index':idxs.ravel(),
+                             'poe':np.tile(matched.poe.values,realizations)})
+
+EARTH_RADIUS = eventindex.EARTH_RADIUS
+lonlat2xyz = eventindex.lonlat2xyz
+
+class SiteIndex(object):
+    '''
+    Spatial index of sites (sid,lon,lat), KD-tree on 3D unit vectors
+    (scipy, brute force if not available) returning the true nearest sites
+    '''
+    def __init__(self,sites):
+        self.sids = sites.sid.values
+        self.xyz = lonlat2xyz(sites.lon.values,sites.lat.values)
+        self.tree = cKDTree(self.xyz) if cKDTree is not None else None
+
+    def k_nearest(self,lon,lat,k=1):
+        '''
+        returns sids of k nearest sites and their great circle distances (km)
+        '''
+        k = min(k,len(self.sids))
+        target = lonlat2xyz([lon],[lat])[0]
+        if self.tree is not None:
+            chord,idx = self.tree.query(target,k=k)
+            chord,idx = np.atleast_1d(chord),np.atleast_1d(idx)
+        else:
+            chord = np.sqrt(((self.xyz-target)**2).sum(axis=1))
+            idx = np.argsort(chord,kind='mergesort')[:k]
+            chord = chord[idx]
+        distance = 2*EARTH_RADIUS*np.arcsin(np.minimum(chord/2,1))
+        return self.sids[idx],distance
+
+    def nearest(self,lon,lat):
+        '''
+        returns sid of nearest site and its great circle distance (km)
+        '''
+        sids,distance = self.k_nearest(lon,lat,1)
+        return int(sids[0]),float(distance[0])
+
+class DisaggregationRepository(object):
+    '''
+    Disaggregation (mean_disagg.csv) and sites (sites.csv) loaded once per process
+    Non-zero bins and bin precision per (sid,poe50y) are cached (LRU, maxsize entries),
+    files are reloaded as soon as they change (mtime)
+    '''
+    def __init__(self,disagg_filename,sites_filename,maxsize=128):
+        self.disagg_filename = disagg_filename
+        self.sites_filename = sites_filename
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.version = None
+        self.cache = collections.OrderedDict()
 
+    def _mtimes(self):
+        return (os.stat(self.disagg_filename).st_mtime_ns,os.stat(self.sites_filename).st_mtime_ns)
+
+    def _reload(self):
+        '''
+        (re)reads files if changed, needs lock
+        '''
+        version = self._mtimes()
+        if version != self.version:
+            self.sites = pandas.read_csv(self.sites_filename)
+            self.disagg = pandas.read_csv(self.disagg_filename)
+            #row positions per (sid,poe50y)
+            self.groups = self.disagg.groupby(['sid','poe50y']).indices
+            self.site_index = SiteIndex(self.sites)
+            self.cache.clear()
+            self.version = version
+
+    def get_keys(self):
+        '''
+        returns all (sid,poe50y) of the disaggregation
+        '''
+        with self.lock:
+            self._reload()
+            return sorted(self.groups.keys())
+
+    def get_version(self):
+        '''
+        returns version (mtimes) of the files
+        '''
+        with self.lock:
+            self._reload()
+            return self.version
+
+    def get_sites(self):
+        '''
+        returns sites (sid,lon,lat)
+        '''
+        with self.lock:
+            self._reload()
+            return self.sites
+
+    def get_site_index(self):
+        '''
+        returns spatial index of sites
+        '''
+        with self.lock:
+            self._reload()
+            return self.site_index
+
+    def get_bins(self,sid,poe50y):
+        '''
+        returns non-zero disaggregation bins (Lon,Lat,Mag,poe) and precision (plon,plat,pmag)
+        of site for given hazard level
+        '''
+        key = (int(sid),float(poe50y))
+        with self.lock:
+            self._reload()
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            if key not in self.groups:
+                raise Exception('No disaggregation for site {} and poe50y {}'.format(*key))
+            dr = self.disagg.iloc[self.groups[key]]
+            #determine precision
+            plon = round(min(np.diff(dr.Lon.unique())),5)
+            plat = round(min(np.diff(dr.Lat.unique())),5)
+            pmag = round(min(np.diff(dr.Mag.unique())),5)
+            #take only those with non-zero poe
+            dr = dr.loc[dr.poe>0,['Lon','Lat','Mag','poe']].reset_index(drop=True)
+            self.cache[key] = (dr,(plon,plat,pmag))
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+            return self.cache[key]
+
+class AssociationTable(object):
+    '''
+    Precomputed candidate ruptures (index labels in the catalog) of each non-zero
+    disaggregation bin for every site and hazard level, stored CSR-style:
+    bins of (sid,poe50y) k are key_offsets[k]:key_offsets[k+1],
+    candidates of bin b are indices[bin_offsets[b]:bin_offsets[b+1]]
+    '''
+    def __init__(self,keys,key_offsets,bin_poe,bin_offsets,indices,version=''):
+        self.keys = np.asarray(keys,dtype='float64').reshape(-1,2)
+        self.key_offsets = np.asarray(key_offsets,dtype='int64')
+        self.bin_poe = np.asarray(bin_poe,dtype='float64')
+        self.bin_offsets = np.asarray(bin_offsets,dtype='int64')
+        self.indices = np.asarray(indices,dtype='int64')
+        #version of catalog the table was built for
+        self.version = str(version)
+        self.lookup = dict(((int(sid),float(poe50y)),k) for k,(sid,poe50y) in enumerate(self.keys))
+
+    @classmethod
+    def load(cls,filename):
+        data = np.load(filename)
+        return cls(data['keys'],data['key_offsets'],data['bin_poe'],data['bin_offsets'],data['indices'],str(data['version']))
+
+    def save(self,filename):
+        np.savez(filename,keys=self.keys,key_offsets=self.key_offsets,bin_poe=self.bin_poe,
+                 bin_offsets=self.bin_offsets,indices=self.indices,version=self.version)
+
+    def sample(self,sid,poe50y,seed=42):
+        '''
+        returns index of single random candidate per bin and poe (same as match_disaggregation)
+        '''
+        key = (int(sid),float(poe50y))
+        if key not in self.lookup:
+            raise Exception('No disaggregation for site {} and poe50y {}'.format(*key))
+        k = self.lookup[key]
+        b0,b1 = self.key_offsets[k],self.key_offsets[k+1]
+        starts = self.bin_offsets[b0:b1]
+        counts = self.bin_offsets[b0+1:b1+1]-starts
+        rng = np.random.default_rng(seed)
+        draw = rng.integers(0,counts) if len(counts)>0 else np.zeros(0,dtype='int64')
+        return [list(self.indices[starts+draw]),list(self.bin_poe[b0:b1])]
+
+def build_association(ruptures,repository=None,version=''):
+    '''
+    Given stochastic ruptures (labels as in catalog) builds the association table
+    of all sites and hazard levels of the disaggregation
+    '''
+    if repository is None:
+        repository = get_repository()
+    keys = []
+    key_offsets = [0]
+    bin_poe = []
+    counts = []
+    indices = []
+    binned = {}
+    for sid,poe50y in repository.get_keys():
+        dr,(plon,plat,pmag) = repository.get_bins(sid,poe50y)
+        #binned once per precision
+        if (plon,plat,pmag) not in binned:
+            keys_xyz = bin_keys(ruptures.longitude.values,ruptures.latitude.values,ruptures.magnitude.values,plon,plat,pmag)
+            binned[(plon,plat,pmag)] = group_bins(keys_xyz,ruptures.index.values)
+        b = binned[(plon,plat,pmag)]
+        matched = match_bins(b,dr,plon,plat,pmag)
+        #candidates of all matched bins (in bin order)
+        count = matched['count'].values
+        positions = np.repeat(matched.start.values-np.concatenate([[0],np.cumsum(count)[:-1]]),count)+np.arange(count.sum())
+        keys.append((sid,poe50y))
+        key_offsets.append(key_offsets[-1]+len(matched))
+        bin_poe.append(matched.poe.values)
+        counts.append(count)
+        indices.append(b['index'][b['order'][positions]])
+    counts = np.concatenate(counts) if counts else np.zeros(0,dtype='int64')
+    bin_offsets = np.concatenate([[0],np.cumsum(counts)])
+    return AssociationTable(keys,key_offsets,
+                            np.concatenate(bin_poe) if bin_poe else [],bin_offsets,
+                            np.concatenate(indices) if indices else [],version)
+
+def match_association(db,lat,lon,poe,association,repository=None):
+    '''
+    Same as match_disaggregation but candidates are looked up in the association table,
+    only the selected events are taken from the catalog (dataframe or store)
+    '''
+    if repository is None:
+        repository = get_repository()
+    sid,_ = repository.get_site_index().nearest(lon,lat)
+    idxs,poe = association.sample(sid,poe,seed=42)
+    matches = take_events(db,idxs)
+    matches['probability']=poe
     return matches
-    #make sure no index problems for following conversion
-    #matches.to_csv('matches.csv',index=False)
-    #matches = matches.reset_index()
 
-    ##convert to catalog style
-    #catalog = oqrup2cat(matches,provider='GFZ')
+_repository = None
 
+def get_repository():
+    '''
+    returns repository of the disaggregation files next to this module (one per process)
+    '''
+    global _repository
+    if _repository is None:
+        filepath=os.path.dirname(__file__)
+        _repository = DisaggregationRepository(os.path.join(filepath,"mean_disagg.csv"),os.path.join(filepath,"sites.csv"))
+    return _repository
 
-    ##save matches
-    #catalog.to_csv('catalog.csv',index=False)
+def match_disaggregation(ruptures,lat,lon,poe,repository=None,binned=None,trace=None):
+    '''
+    Given a set of ruptures (dataframe or mapped catalog of all events), a target with longitude/latitude,
+    and a target exceedance probability (e.g., 0.1 = 10%) for 50 years return period
+    picks up corresponding deaggregation and selects a single random event
+    from the rupture for each bin
+    binned (dict) can be passed to share binned ruptures (per precision) between calls
+    for the same ruptures, trace (querytrace.QueryTrace) records the stages
+    '''
+    trace = querytrace.get_trace(trace)
+    if repository is None:
+        repository = get_repository()
+    #find closest deaggregation site to target (sites are read if changed)
+    with trace.stage('disaggregation_site'):
+        sid,_ = repository.get_site_index().nearest(lon,lat)
+    #get deaggregation for specified hazard level and site
+    with trace.stage('disaggregation_bins') as stage:
+        dr,(plon,plat,pmag) = repository.get_bins(sid,poe)
+        stage.rows_out = len(dr)
+    #bin the ruptures (memoized per catalog version and precision)
+    if binned is None:
+        binned = {}
+    with trace.stage('binning',len(ruptures)) as stage:
+        if (plon,plat,pmag) not in binned:
+            binned[(plon,plat,pmag)] = get_binned(ruptures,plon,plat,pmag)
+        stage.rows_out = len(binned[(plon,plat,pmag)]['groups'])
 
-#print(time.time()-t0)
+    #select events
+    with trace.stage('matching',len(dr)) as stage:
+        idxs,poe = sample_binned(binned[(plon,plat,pmag)],dr,plon,plat,pmag,seed=42)
+        matches = take_events(ruptures,idxs)
+        matches['probability']=poe
+        stage.rows_out = len(matches)
 
+    return matches
 
+def match_disaggregation_realizations(ruptures,lat,lon,poe,realizations=100,seed=42,processes=1,repository=None):
+    '''
+    Same as match_disaggregation but returns realizations stacked
+    (column realization) of randomly selected events per bin
+    '''
+    if repository is None:
+        repository = get_repository()
+    sid,_ = repository.get_site_index().nearest(lon,lat)
+    dr,(plon,plat,pmag) = repository.get_bins(sid,poe)
+    binned = get_binned(ruptures,plon,plat,pmag)
+    samples = sample_realizations(binned,dr,plon,plat,pmag,realizations,seed,processes)
+    matches = take_events(ruptures,samples['index'].values)
+    matches['probability'] = samples.poe.values
+    matches['realization'] = samples.realization.values
+    return matches
 
+def main():
+    parser = argparse.ArgumentParser(description='Prepares OQ ruptures and disaggregation for event queries')
+    commands = parser.add_subparsers(dest='command')
+    ingest = commands.add_parser('ingest',help='converts OQ rupture exports to catalog style and adds them to a SQLite event store')
+    ingest.add_argument('ruptures',nargs='+',help='OQ rupture exports (e.g., ruptures_3411.csv)')
+    ingest.add_argument('dbfile',help='SQLite event store (created if not existing)')
+    ingest.add_argument('--type',default='stochastic',help='event type (default: stochastic)')
+    ingest.add_argument('--chunksize',type=int,default=100000,help='ruptures per chunk')
+    associate = commands.add_parser('associate',help='precomputes candidate ruptures of all disaggregation bins (sites.csv,mean_disagg.csv)')
+    associate.add_argument('catalog',help='csv catalog or SQLite event store')
+    associate.add_argument('outfile',help='association table to create (.npz)')
+    args = parser.parse_args()
+    if args.command=='ingest':
+        store = eventstore.EventStore(args.dbfile)
+        def progress(written):
+            sys.stderr.write('\r{} ruptures written'.format(written))
+        ingest_ruptures(args.ruptures,store,dtype=args.type,chunksize=args.chunksize,progress=progress)
+        sys.stderr.write('\n')
+        store.close()
+    elif args.command=='associate':
+        if args.catalog.endswith('.csv'):
+            catalog = pandas.read_csv(args.catalog)
+            #as read_database (eventquery)
+            version = (os.path.abspath(args.catalog),os.stat(args.catalog).st_mtime_ns)
+            ruptures = catalog[catalog.type=='stochastic']
+        else:
+            store = eventstore.EventStore(args.catalog)
+            version = store.version
+            ruptures = store.select('deaggregation',spatial=False)
+        build_association(ruptures,version=version).save(args.outfile)
+    else:
+        parser.print_help()
 
-##determine precision of disaggregation (up to 5 digits)
-#plon = round(min(np.diff(dr.Lon.unique())),5)
-#plat = round(min(np.diff(dr.Lat.unique())),5)
-#pmag = round(min(np.diff(dr.Mag.unique())),5)
-#
-##bin the ruptures
-#bins = binning_xyz(rup[['centroid_lon','centroid_lat','mag']],plon,plat,pmag)
-
-#associate each event in OQruptures with poe in dr
-#rup['poe'] = 0.
-#get matches
-#poes,idxs = match_row(bins,dr)
-#rup['poe'] = match_row(bins,dr)
-
-##TAKE ONLY NON-ZERO
-#print('WARNING: CONSIDERING ONLY DISAGGREGATION BINS WITH POE > 0')
-#dr = dr[dr.poe>0]
-#
-##selects events
-#idxs,poe = return_random_event(bins,dr,seed=42)
-#matches = rup.loc[idxs]
-#matches['poe']=poe
-##make sure no index problems for following conversion
-#matches.to_csv('matches.csv',index=False)
-#matches = matches.reset_index()
-#
-##convert to catalog style
-#catalog = oqrup2cat(matches,provider='GFZ')
-#
-#
-##save matches
-#catalog.to_csv('catalog.csv',index=False)
-#
-#print(time.time()-t0)
+if __name__ =='__main__':
+    main()
@@ -0,0 +1,129 @@
+#####################################
+# Output encodings of event catalogs besides (pretty printed) QuakeML:
+# compact QuakeML, GeoJSON, CSV, Arrow IPC and Parquet, optionally gzip compressed
+import io
+import gzip
+import json
+import pandas
+#from . import quakeml
+import quakeml
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    #Arrow and Parquet not available
+    pyarrow = None
+
+def plain_catalog(catalog):
+    '''
+    returns catalog with the compact types of eventquery.compact_database
+    (categoricals, sparse, float32, small integers) converted back to the types read
+    from csv, float32 values at their shortest representation (0.1 stays 0.1):
+    encodings do not depend on how the catalog is held in memory
+    '''
+    columns = {}
+    for column in catalog.columns:
+        values = catalog[column]
+        if isinstance(values.dtype,pandas.CategoricalDtype):
+            values = values.astype(values.dtype.categories.dtype)
+        elif isinstance(values.dtype,pandas.SparseDtype):
+            values = values.sparse.to_dense()
+        if values.dtype == 'float32':
+            values = values.astype(str).astype('float64')
+        elif values.dtype.kind in 'iu' and values.dtype.itemsize < 8:
+            values = values.astype('int64')
+        if values is not catalog[column]:
+            columns[column] = values
+    return catalog.assign(**columns) if columns else catalog
+
+FEATURE_TEMPLATE = '{"type":"Feature","id":%s,"geometry":{"type":"Point","coordinates":[%s]},"properties":%s}'
+
+def events2geojson(catalog):
+    '''
+    Given a pandas dataframe with events returns GeoJSON FeatureCollection,
+    one Point feature (longitude, latitude, depth in km) per event with
+    all columns as properties
+    '''
+    if len(catalog)==0:
+        return '{"type":"FeatureCollection","features":[]}'
+    catalog = plain_catalog(catalog)
+    #json of all rows/coordinates at once, split into events
+    properties = catalog.to_json(orient='records',lines=True,double_precision=15).rstrip('\n').split('\n')
+    coordinates = catalog[['longitude','latitude','depth']].to_json(orient='values',double_precision=15)[2:-2].split('],[')
+    ids = [json.dumps(str(i)) for i in catalog['eventID'].tolist()]
+    features = [FEATURE_TEMPLATE % f for f in zip(ids,coordinates,properties)]
+    return '{"type":"FeatureCollection","features":['+','.join(features)+']}'
+
+def events2csv(catalog):
+    '''
+    Given a pandas dataframe with events returns csv (layout of the catalog csv)
+    '''
+    return catalog.to_csv(index=False)
+
+def events2table(catalog):
+    '''
+    returns catalog as arrow table
+    '''
+    if pyarrow is None:
+        raise Exception('Arrow/Parquet output requires pyarrow, e.g. pip install pyarrow')
+    #same schema for compact catalogs (sparse columns are not supported by arrow)
+    catalog = plain_catalog(catalog)
+    return pyarrow.Table.from_pandas(catalog,preserve_index=False)
+
+def events2arrow(catalog):
+    '''
+    Given a pandas dataframe with events returns Arrow IPC (stream format) bytes
+    '''
+    table = events2table(catalog)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink,table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def events2parquet(catalog):
+    '''
+    Given a pandas dataframe with events returns Parquet bytes
+    '''
+    table = events2table(catalog)
+    sink = io.BytesIO()
+    pyarrow.parquet.write_table(table,sink)
+    return sink.getvalue()
+
+#output format: (writer, content type)
+FORMATS = {
+    'quakeml':(lambda catalog,provider: quakeml.events2quakeml_bulk(catalog,provider),'application/xml'),
+    'quakeml-compact':(lambda catalog,provider: quakeml.events2quakeml_bulk(catalog,provider,pretty=False),'application/xml'),
+    'geojson':(lambda catalog,provider: events2geojson(catalog),'application/geo+json'),
+    'csv':(lambda catalog,provider: events2csv(catalog),'text/csv'),
+    'arrow':(lambda catalog,provider: events2arrow(catalog),'application/vnd.apache.arrow.stream'),
+    'parquet':(lambda catalog,provider: events2parquet(catalog),'application/vnd.apache.parquet'),
+}
+COMPRESSIONS = [None,'gzip']
+
+def content_type(output_format):
+    '''
+    returns (HTTP) content type of output format
+    '''
+    ctype = FORMATS[output_format][1]
+    if ctype.startswith('text/') or ctype.endswith('xml') or ctype.endswith('json'):
+        ctype += '; charset=utf-8'
+    return ctype
+
+def encode_events(catalog,output_format='quakeml',compression=None,provider='GFZ'):
+    '''
+    Given a pandas dataframe with events returns it encoded as output_format
+    (see FORMATS), as string for text formats or bytes (binary formats and if compressed)
+    compression can be None or gzip
+    '''
+    if output_format not in FORMATS:
+        raise ValueError('Unknown output format: {} (one of {})'.format(output_format,', '.join(FORMATS)))
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression: {}'.format(compression))
+    encoded = FORMATS[output_format][0](catalog,provider)
+    if compression=='gzip':
+        if isinstance(encoded,str):
+            encoded = encoded.encode('utf-8')
+        #no timestamp: same query, same bytes
+        encoded = gzip.compress(encoded,mtime=0)
+    return encoded
@@ -0,0 +1,179 @@
+#####################################
+# Spatio-temporal index of event catalogs for radius and time window queries
+# (epoch time of events, KD-tree of locations and events sorted by time)
+import threading
+import collections
+import numpy as np
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    #fall back to (vectorized) brute force search
+    cKDTree = None
+
+EARTH_RADIUS = 6371.0
+
+def lonlat2xyz(lon,lat):
+    '''
+    converts longitude/latitude (degree) to unit vectors (n,3)
+    '''
+    lon = np.radians(np.asarray(lon,dtype='float64'))
+    lat = np.radians(np.asarray(lat,dtype='float64'))
+    return np.column_stack([np.cos(lat)*np.cos(lon),np.cos(lat)*np.sin(lon),np.sin(lat)])
+
+def haversine(lat1,lon1,lat2,lon2):
+    '''
+    great circle distance (km) between points (degree), vectorized
+    '''
+    lat1,lon1,lat2,lon2 = [np.radians(np.asarray(v,dtype='float64')) for v in [lat1,lon1,lat2,lon2]]
+    a = np.sin((lat2-lat1)/2)**2+np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.minimum(a,1)))
+
+def bounding_box(lat,lon,radius):
+    '''
+    returns lonmin,lonmax,latmin,latmax containing all points within radius (km),
+    all longitudes if the circle contains a pole or crosses the date line
+    '''
+    dlat = np.degrees(radius/EARTH_RADIUS)
+    latmin,latmax = lat-dlat,lat+dlat
+    if latmin <= -90 or latmax >= 90:
+        return -180.,180.,max(latmin,-90.),min(latmax,90.)
+    dlon = np.degrees(np.arcsin(min(np.sin(radius/EARTH_RADIUS)/np.cos(np.radians(lat)),1.)))
+    if lon-dlon < -180 or lon+dlon > 180 or dlon >= 90:
+        return -180.,180.,latmin,latmax
+    return lon-dlon,lon+dlon,latmin,latmax
+
+def epoch_seconds(catalog):
+    '''
+    returns time of events (year, month, day, hour, minute, second columns)
+    as seconds since 1970-01-01T00:00:00Z, missing values as in the QuakeML (quakeml.format_utc)
+    '''
+    d = catalog[['year','month','day','hour','minute','second']].fillna(0)
+    year = d.year.to_numpy(dtype='int64')
+    month = d.month.clip(lower=1).to_numpy(dtype='int64')
+    day = d.day.clip(lower=1).to_numpy(dtype='int64')
+    months = (year-1970)*12+month-1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype('int64')+day-1
+    return (days*86400+d.hour.to_numpy(dtype='int64')*3600+d.minute.to_numpy(dtype='int64')*60
+            +d.second.to_numpy(dtype='float64'))
+
+def to_epoch(value):
+    '''
+    converts time (seconds since 1970, ISO 8601 string e.g. 2010-02-27T06:34:11Z,
+    datetime or numpy datetime64) to seconds since 1970, None stays None,
+    raises ValueError for invalid times
+    '''
+    if value is None:
+        return None
+    if isinstance(value,(int,float,np.number)):
+        return float(value)
+    if isinstance(value,str):
+        value = value.strip()
+        try:
+            return float(value)
+        except ValueError:
+            #UTC only
+            value = value.rstrip('Zz')
+    value = np.datetime64(value,'us')
+    if np.isnat(value):
+        raise ValueError('Invalid time: {}'.format(value))
+    return float(value.astype('int64'))/1e6
+
+class EventIndex(object):
+    '''
+    Index of events (row positions) by location (KD-tree on 3D unit vectors,
+    brute force if scipy is not available) and by time (positions sorted by epoch)
+    Candidates are refined by the exact (haversine) distance
+    '''
+    def __init__(self,longitude,latitude,epoch):
+        self.longitude = np.asarray(longitude,dtype='float64')
+        self.latitude = np.asarray(latitude,dtype='float64')
+        self.epoch = np.asarray(epoch,dtype='float64')
+        #events without location are never within a radius
+        self.located = np.flatnonzero(~(np.isnan(self.longitude) | np.isnan(self.latitude)))
+        self.tree = None
+        if cKDTree is not None:
+            self.tree = cKDTree(lonlat2xyz(self.longitude[self.located],self.latitude[self.located]))
+        self.order = np.argsort(self.epoch,kind='mergesort')
+        self.sorted_epoch = self.epoch[self.order]
+
+    def __len__(self):
+        return len(self.epoch)
+
+    def within(self,lat,lon,radius,positions=None):
+        '''
+        returns sorted positions of events (of positions if given) within radius (km) of lat/lon
+        '''
+        if positions is None:
+            if self.tree is not None:
+                #chord of radius (slightly enlarged, refined below)
+                chord = 2*np.sin(min(radius/EARTH_RADIUS,np.pi)/2)*(1+1e-9)
+                candidates = self.located[self.tree.query_ball_point(lonlat2xyz([lon],[lat])[0],chord)]
+            else:
+                candidates = self.located
+        else:
+            candidates = positions
+        distance = haversine(lat,lon,self.latitude[candidates],self.longitude[candidates])
+        return np.sort(candidates[distance <= radius])
+
+    def _window(self,tmin,tmax):
+        '''
+        returns range of events sorted by time with tmin <= epoch <= tmax
+        '''
+        lo = 0 if tmin is None else np.searchsorted(self.sorted_epoch,tmin,side='left')
+        hi = len(self.sorted_epoch) if tmax is None else np.searchsorted(self.sorted_epoch,tmax,side='right')
+        return lo,hi
+
+    def between(self,tmin=None,tmax=None):
+        '''
+        returns sorted positions of events with tmin <= epoch <= tmax
+        '''
+        lo,hi = self._window(tmin,tmax)
+        return np.sort(self.order[lo:hi])
+
+    def select(self,lat=0,lon=0,radius=None,tmin=None,tmax=None):
+        '''
+        returns sorted positions of events within radius (km, None: everywhere)
+        of lat/lon and between tmin and tmax (seconds since 1970, None: open)
+        '''
+        if radius is None:
+            return self.between(tmin,tmax)
+        if tmin is None and tmax is None:
+            return self.within(lat,lon,radius)
+        #start with the time window if it is small, otherwise with the radius
+        lo,hi = self._window(tmin,tmax)
+        if self.tree is None or hi-lo < len(self)//8:
+            return self.within(lat,lon,radius,self.between(tmin,tmax))
+        positions = self.within(lat,lon,radius)
+        epoch = self.epoch[positions]
+        if tmin is not None:
+            positions = positions[epoch >= tmin]
+            epoch = epoch[epoch >= tmin]
+        if tmax is not None:
+            positions = positions[epoch <= tmax]
+        return positions
+
+#indices per catalog version
+INDEX_MAXSIZE = 4
+_indices = collections.OrderedDict()
+_indices_lock = threading.Lock()
+
+def get_index(catalog):
+    '''
+    returns index of catalog (pandas dataframe), memoized per catalog version
+    (attrs['version']) and rows
+    '''
+    version = catalog.attrs.get('version')
+    key = None
+    if version is not None and len(catalog)>0:
+        key = (version,len(catalog),catalog.index[0],catalog.index[-1])
+        with _indices_lock:
+            if key in _indices:
+                _indices.move_to_end(key)
+                return _indices[key]
+    index = EventIndex(catalog.longitude.to_numpy(dtype='float64'),catalog.latitude.to_numpy(dtype='float64'),epoch_seconds(catalog))
+    if key is not None:
+        with _indices_lock:
+            _indices[key] = index
+            while len(_indices) > INDEX_MAXSIZE:
+                _indices.popitem(last=False)
+    return index
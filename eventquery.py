@@ -1,27 +1,101 @@
+import numpy
 import pandas
 import os
-import lxml.etree as le
+import inspect
+import logging
+import itertools
+import threading
+import collections
 #from . import quakeml
 import quakeml
 #from . import disaggregation_oq_sources as dos
 import disaggregation_oq_sources as dos
+#from . import eventstore
+import eventstore
+#from . import querycache
+import querycache
+#from . import querytrace
+import querytrace
+#from . import eventformats
+import eventformats
+#from . import eventindex
+import eventindex
+
+logger = logging.getLogger('quakeledger.query')
 
 #DUMMY DATA STUFF SHOULD BE CHANGED AS SOON AS STORAGE ETC IS FINALLY DECIDED
-#FIXME:currently only csv
-def read_database(conn):
+#compact in-memory schema
+#NOTE: columns used by the filters (longitude,latitude,depth,magnitude,probability) stay float64,
+#      in float32 e.g. a magnitude of 6.6 would be smaller than mmin=6.6
+CATEGORY_COLUMNS = ['type','Agency','Identifier','fuzzy']
+INTEGER_COLUMNS = ['year','month','day','hour','minute']
+FLOAT32_COLUMNS = ['timeError','timeUncertainty','longitudeUncertainty','latitudeUncertainty',
+                   'horizontalUncertainty','maxHorizontalUncertainty','minHorizontalUncertainty','azimuthMaxHorizontalUncertainty',
+                   'SemiMajor90','SemiMinor90','ErrorStrike','depthError','depthUncertainty',
+                   'sigmaMagnitude','magnitudeUncertainty','strike','strikeUncertainty','dip','dipUncertainty','rake','rakeUncertainty']
+#float32 columns with more missing values than this fraction are kept sparse
+SPARSE_FRACTION = 0.5
+
+def compact_database(db):
+    '''
+    converts catalog to compact types (categoricals, smallest integers,
+    float32 and sparse mostly empty columns)
+    '''
+    db = db.copy()
+    for column in db.columns:
+        values = db[column]
+        if column in CATEGORY_COLUMNS:
+            db[column] = values.astype('category')
+        elif column in INTEGER_COLUMNS and values.notna().all():
+            db[column] = pandas.to_numeric(values,downcast='integer')
+        elif column in FLOAT32_COLUMNS:
+            values = values.astype('float32')
+            if values.isna().mean() > SPARSE_FRACTION:
+                values = values.astype(pandas.SparseDtype('float32',numpy.nan))
+            db[column] = values
+    return db
+
+def memory_footprint(db):
+    '''
+    returns memory used by catalog (bytes) per column and in total
+    '''
+    usage = db.memory_usage(deep=True)
+    usage['total'] = usage.sum()
+    return usage
+
+def read_database(conn,compact=False):
     '''
     get data from database
+    compact: catalog is kept in compact types (see compact_database)
     '''
-    return pandas.read_csv(conn)
+    db = pandas.read_csv(conn)
+    if compact:
+        db = compact_database(db)
+    #to detect changes of the underlying data (same for relative and absolute paths)
+    db.attrs['version'] = (os.path.abspath(conn),os.stat(conn).st_mtime_ns)
+    return db
 
-def connect(provider='GFZ'):
+def connect(provider='GFZ',storage='csv',compact=False):
     '''
     connects to service
+    storage can be:
+        -csv    (whole catalog is read into memory, compact: with compact types)
+        -sqlite (indexed store, filters are evaluated by the store
+                 --> create once with: python eventstore.py valparaiso_v1.3.csv valparaiso_v1.3.sqlite)
+        -mmap   (memory-mapped columns shared by all worker processes
+                 --> create once with: python eventstore.py --format mmap valparaiso_v1.3.csv valparaiso_v1.3.npy)
     '''
     filepath=os.path.dirname(__file__)
-    filename = os.path.join(filepath,"valparaiso_v1.3.csv")
     if provider=='GFZ':
-        return read_database(filename)
+        if storage=='sqlite':
+            return eventstore.EventStore(os.path.join(filepath,"valparaiso_v1.3.sqlite"))
+        if storage=='mmap':
+            return eventstore.MappedCatalog(os.path.join(filepath,"valparaiso_v1.3.npy"))
+        filename = os.path.join(filepath,"valparaiso_v1.3.csv")
+        return read_database(filename,compact)
+
+#event types of queries (etype)
+ETYPES = ['observed','stochastic','expert','deaggregation']
 
 #FUNCTIONS
 def convert_360(lon):
@@ -50,14 +124,233 @@ def filter_type(db,etype,probability):
         #get stochastic events
         return db[(db.type=='stochastic')]
 
+def valid_association(db,association):
+    '''
+    checks if association table was built for this version of the catalog
+    '''
+    if association is None:
+        return False
+    if association.version != str(catalog_version(db)):
+        logger.warning('association table (catalog version %s) does not match catalog version %s, ruptures are binned',
+                       association.version,catalog_version(db))
+        return False
+    return True
+
 def filter_magnitude(db,mmin,mmax):
     '''
     filters magnitude
     '''
     return db[(db.magnitude >= mmin) & (db.magnitude <= mmax)]
 
+def filter_radius(db,tlat,tlon,radius):
+    '''
+    filters distance (km) to target
+    '''
+    return db[eventindex.haversine(tlat,tlon,db.latitude.values,db.longitude.values) <= radius]
+
+def filter_time(db,tmin=None,tmax=None):
+    '''
+    filters time (seconds since 1970 or ISO 8601 UTC, None: open)
+    '''
+    if tmin is None and tmax is None:
+        return db
+    epoch = eventindex.epoch_seconds(db)
+    mask = numpy.ones(len(db),dtype=bool)
+    if tmin is not None:
+        mask &= epoch >= eventindex.to_epoch(tmin)
+    if tmax is not None:
+        mask &= epoch <= eventindex.to_epoch(tmax)
+    return db[mask]
+
+#UPDATE
+#versions of upserted in-memory catalogs: version -> (previous version,changed types)
+UPSERT_CHANGES_MAXSIZE = 256
+_upsert_changes = collections.OrderedDict()
+_upsert_counter = itertools.count(1)
+_upsert_lock = threading.Lock()
+
+def is_compact(db):
+    return any(isinstance(dtype,(pandas.CategoricalDtype,pandas.SparseDtype)) for dtype in db.dtypes)
+
+def dense_database(db):
+    '''
+    converts catalog from compact types (categoricals, sparse) back to plain columns
+    '''
+    columns = {}
+    for column in db.columns:
+        dtype = db[column].dtype
+        if isinstance(dtype,pandas.CategoricalDtype):
+            columns[column] = db[column].astype(dtype.categories.dtype)
+        elif isinstance(dtype,pandas.SparseDtype):
+            columns[column] = db[column].sparse.to_dense()
+    return db.assign(**columns) if columns else db
+
+def upsert_events(db,events):
+    '''
+    Adds events (QuakeML file/string or pandas dataframe) to the catalog without reloading it
+    events are identified by eventID: known events are updated (the given columns,
+    they keep their position), new events are appended
+    dataframes are taken as they are (see quakeml.drop_placeholders for events read from quakeml)
+    Stores (eventstore.EventStore) are updated in place and returned,
+    for in-memory catalogs a new catalog (with a new version) is returned,
+    the old one is left unchanged for queries still running on it
+    Cached queries (query_events_cached) of event types not affected are kept
+    '''
+    if not isinstance(events,pandas.DataFrame):
+        #columns missing in quakeml (e.g., probability) keep their stored values
+        events = quakeml.drop_placeholders(quakeml.quakeml2events(events))
+    events = events.drop_duplicates('eventID',keep='last')
+    if not isinstance(db,pandas.DataFrame):
+        if not hasattr(db,'upsert'):
+            raise Exception('Catalog cannot be updated, export it again (python eventstore.py --format mmap)')
+        db.upsert(events)
+        return db
+    #positions of known events (last one if an eventID is not unique)
+    positions = pandas.Series(numpy.arange(len(db)),index=db.eventID.astype(str).values)
+    positions = positions[~positions.index.duplicated(keep='last')]
+    matched = events.eventID.astype(str).map(positions)
+    updates = events[matched.notna().values]
+    added = events[matched.isna().values]
+    columns = [c for c in events.columns if c in db.columns]
+    dense = dense_database(db)
+    types = set(dense.type.iloc[matched.dropna().astype('int64')].dropna().astype(str))
+    if 'type' in events.columns:
+        types |= set(events.type.dropna().astype(str))
+
+    #updated rows keep their labels, new rows get the next labels
+    rows = dense.iloc[matched.dropna().astype('int64').values].copy()
+    for column in columns:
+        rows[column] = updates[column].values
+    new = added[columns].reindex(columns=dense.columns)
+    start = dense.index.max()+1 if len(dense) > 0 else 0
+    new.index = pandas.RangeIndex(start,start+len(new))
+    updated = pandas.concat([dense.drop(index=rows.index),rows]).loc[dense.index]
+    updated = pandas.concat([updated,new]) if len(new) > 0 else updated
+    if is_compact(db):
+        updated = compact_database(updated)
+
+    old_version = catalog_version(db)
+    with _upsert_lock:
+        version = ('upsert',next(_upsert_counter))
+        _upsert_changes[version] = (old_version,types)
+        while len(_upsert_changes) > UPSERT_CHANGES_MAXSIZE:
+            _upsert_changes.popitem(last=False)
+    updated.attrs['version'] = version
+    return updated
+
+def changed_types(db,since):
+    '''
+    returns types of events changed since catalog version since,
+    None if unknown (e.g., catalog was reloaded)
+    '''
+    if not isinstance(db,pandas.DataFrame):
+        return db.changed_types(since) if hasattr(db,'changed_types') else None
+    version = catalog_version(db)
+    types = set()
+    with _upsert_lock:
+        while version != since:
+            if version not in _upsert_changes:
+                return None
+            version,changed = _upsert_changes[version]
+            types |= changed
+    return types
+
 #QUERY
-def query_events(db, num_events = -1, lonmin=-180,lonmax=180,latmin=-90,latmax=90,mmin=0,mmax=12,zmin=0,zmax=999,p=0,tlat=0,tlon=0,etype='stochastic'):
+def select_events(db, num_events = -1, lonmin=-180,lonmax=180,latmin=-90,latmax=90,mmin=0,mmax=12,zmin=0,zmax=999,p=0,tlat=0,tlon=0,etype='stochastic',offset=0,association=None,radius=None,tmin=None,tmax=None,chunksize=None,trace=None):
+    '''
+    Returns selected events (see query_events) as pandas dataframe sorted by magnitude
+    If chunksize is given, events of a store are returned as generator of dataframes
+    with chunksize events (other sources are kept as single dataframe)
+    trace (querytrace.QueryTrace) records the stages
+    '''
+    trace = querytrace.get_trace(trace)
+    #convert 360 degree longitude in case
+    if lonmin > 180:
+        lonmin = convert_360(lonmin)
+    if lonmax > 180:
+        lonmax = convert_360(lonmax)
+    tmin = eventindex.to_epoch(tmin)
+    tmax = eventindex.to_epoch(tmax)
+    indexed = radius is not None or tmin is not None or tmax is not None
+
+    if not isinstance(db,pandas.DataFrame) and etype != 'deaggregation':
+        #store: filters, sorting and paging are pushed down (optionally streamed)
+        with trace.stage('store_select') as stage:
+            selected = db.select(etype,p,lonmin,lonmax,latmin,latmax,zmin,zmax,mmin,mmax,sort=True,limit=num_events,offset=offset,chunksize=chunksize,
+                                 radius=radius,tlat=tlat,tlon=tlon,tmin=tmin,tmax=tmax)
+            if not chunksize:
+                stage.rows_out = len(selected)
+        return selected
+
+    if etype == 'deaggregation' and valid_association(db,association):
+        #candidates are precomputed, only the selected events are read
+        with trace.stage('match_association') as stage:
+            selected = dos.match_association(db,tlat,tlon,p,association)
+            stage.rows_out = len(selected)
+    else:
+        if isinstance(db,pandas.DataFrame):
+            selected = db
+            if indexed and etype != 'deaggregation' and db.attrs.get('version') is not None:
+                #candidates within radius/time window from the (memoized) index, in catalog order
+                with trace.stage('index',len(db)) as stage:
+                    selected = db.iloc[eventindex.get_index(db).select(tlat,tlon,radius,tmin,tmax)]
+                    stage.rows_out = len(selected)
+            elif indexed and etype != 'deaggregation':
+                #without version the index would be rebuilt per query, a scan is cheaper
+                with trace.stage('filter_radius_time',len(db)) as stage:
+                    if radius is not None:
+                        selected = filter_radius(selected,tlat,tlon,radius)
+                    selected = filter_time(selected,tmin,tmax)
+                    stage.rows_out = len(selected)
+            #filter type and probability
+            with trace.stage('filter_type',len(selected)) as stage:
+                selected = filter_type(selected,etype,p)
+                stage.rows_out = len(selected)
+        elif isinstance(db,eventstore.MappedCatalog):
+            #ruptures are binned on the mapped columns, only the matched events are copied
+            selected = db
+        else:
+            #store: filters are pushed down (except for deaggregation which needs all stochastic events)
+            with trace.stage('store_select') as stage:
+                selected = db.select(etype,p,lonmin,lonmax,latmin,latmax,zmin,zmax,mmin,mmax,spatial=etype!='deaggregation')
+                stage.rows_out = len(selected)
+
+        #deaggregation
+        if etype == 'deaggregation':
+            #get events matching deaggregation for target
+            selected = dos.match_disaggregation(selected,tlat,tlon,p,trace=trace)
+
+    if isinstance(db,pandas.DataFrame) or etype == 'deaggregation':
+        #spatial filter
+        with trace.stage('filter_spatial',len(selected)) as stage:
+            selected = filter_spatial(selected,lonmin,lonmax,latmin,latmax,zmin,zmax)
+            stage.rows_out = len(selected)
+
+        #magnitude filter
+        with trace.stage('filter_magnitude',len(selected)) as stage:
+            selected = filter_magnitude(selected,mmin,mmax)
+            stage.rows_out = len(selected)
+
+    if indexed and etype == 'deaggregation':
+        #radius/time of the matched events
+        with trace.stage('filter_radius_time',len(selected)) as stage:
+            if radius is not None:
+                selected = filter_radius(selected,tlat,tlon,radius)
+            selected = filter_time(selected,tmin,tmax)
+            stage.rows_out = len(selected)
+
+    #sort according to magnitude and filter according to num_events/offset
+    with trace.stage('sort',len(selected)) as stage:
+        if (num_events > 0 ):
+            #only the largest events, no full sort (ties stay in catalog order as for the stable sort)
+            selected = selected.nlargest(offset+num_events,'magnitude',keep='first').iloc[offset:]
+        else:
+            selected = selected.sort_values('magnitude',ascending=False,kind='mergesort').iloc[offset:]
+        stage.rows_out = len(selected)
+
+    return selected
+
+def query_events(db, num_events = -1, lonmin=-180,lonmax=180,latmin=-90,latmax=90,mmin=0,mmax=12,zmin=0,zmax=999,p=0,tlat=0,tlon=0,etype='stochastic',offset=0,association=None,radius=None,tmin=None,tmax=None,output_format='quakeml',compression=None,trace=None):
     '''
     Returns set of events
     type can be:
@@ -69,43 +362,192 @@ def query_events(db, num_events = -1, lonmin=-180,lonmax=180,latmin=-90,latmax=9
 
     Optional Constraints
         - num_events: number of events to be returned. Default -1 i.e. all available events
-        - target: tlat,tlon (for deaggregation)
+        - target: tlat,tlon (for deaggregation and radius)
+        - radius: maximum distance (km) of events to target (default None i.e. no limit)
+        - time window: tmin,tmax (seconds since 1970 or ISO 8601 UTC e.g. 2010-02-27T06:34:11Z, default None i.e. open)
         - event location region: lonmin,lonmax,latmin,latmax (default:-180,180,-90,90)
         - minimum magnitude: mmin (Mw, default:0)
         - maximum magnitude: mmax (Mw, default:12)
         - maximum depth: zmax (km, default 999)
         - probability: p (interpretation depends on type see above)
+        - offset: number of (largest) events to skip, for paging with num_events (default 0)
+        - association: precomputed association table of deaggregation bins and ruptures
+                       (disaggregation_oq_sources.AssociationTable, used if built for this catalog)
+        - output_format: quakeml (default), quakeml-compact (not pretty printed), geojson, csv,
+                         arrow (IPC stream) or parquet (arrow/parquet require pyarrow, returned as bytes)
+        - compression: None (default) or gzip (returns bytes)
+        - trace: querytrace.QueryTrace recording wall time, rows and memory per stage (default None i.e. disabled)
     '''
-    #filter type and probability
-    selected = filter_type(db,etype,p)
+    trace = querytrace.get_trace(trace)
+    with trace.query():
+        selected = select_events(db,num_events,lonmin,lonmax,latmin,latmax,mmin,mmax,zmin,zmax,p,tlat,tlon,etype,offset,association,
+                                 radius=radius,tmin=tmin,tmax=tmax,trace=trace)
 
-    #deaggregation
-    if etype == 'deaggregation':
-        #get events matching deaggregation for target
-        selected = dos.match_disaggregation(selected,tlat,tlon,p)
+        #convert to quakeml (or other output format)
+        with trace.stage('encode',len(selected)):
+            selected=eventformats.encode_events(selected,output_format,compression,provider='GFZ')
 
-    #convert 360 degree longitude in case
-    if lonmin > 180:
-        lonmin = convert_360(lonmin)
-    if lonmax > 180:
-        lonmax = convert_360(lonmax)
+    return selected
+
+def query_events_batch(db, queries, combined=False):
+    '''
+    Evaluates many queries (list of dicts with query_events keyword arguments)
+    in one pass over the catalog and returns list with the result per query
+    (QuakeML or output_format, see query_events), or a single QuakeML with the
+    events of all queries if combined (output_format/compression are not supported then)
+    The catalog is sorted by magnitude once, magnitude ranges are looked up
+    by binary search and type/spatial filters are evaluated as vectorized masks,
+    deaggregation queries share the binned ruptures
+    '''
+    #encoding per query
+    encodings = [(query.get('output_format','quakeml'),query.get('compression')) for query in queries]
+    queries = [dict((k,v) for k,v in query.items() if k not in ['output_format','compression']) for query in queries]
+    if combined and any(encoding != ('quakeml',None) for encoding in encodings):
+        raise ValueError('combined batch queries return (uncompressed) quakeml only')
+    results = []
+    if not isinstance(db,pandas.DataFrame):
+        #store: filters are pushed down per query
+        results = [select_events(db,**query) for query in queries]
+    else:
+        #sort once (stable, same order as select_events)
+        ordered = db.sort_values('magnitude',ascending=False,kind='mergesort')
+        #descending magnitude as ascending array for searchsorted (NaN last)
+        neg_magnitude = -ordered.magnitude.values
+        longitude = ordered.longitude.values
+        latitude = ordered.latitude.values
+        depth = ordered.depth.values
+        type_masks = {}
+        epoch = None
+        ruptures = None
+        binned = {}
+        defaults = dict((k,v.default) for k,v in inspect.signature(select_events).parameters.items() if k != 'db')
+        for query in queries:
+            q = dict(defaults,**query)
+            if q['lonmin'] > 180:
+                q['lonmin'] = convert_360(q['lonmin'])
+            if q['lonmax'] > 180:
+                q['lonmax'] = convert_360(q['lonmax'])
+            q['tmin'] = eventindex.to_epoch(q['tmin'])
+            q['tmax'] = eventindex.to_epoch(q['tmax'])
+            if q['etype'] == 'deaggregation':
+                if valid_association(db,q['association']):
+                    selected = dos.match_association(db,q['tlat'],q['tlon'],q['p'],q['association'])
+                else:
+                    #stochastic ruptures are binned once for all targets
+                    if ruptures is None:
+                        ruptures = filter_type(db,'deaggregation',0)
+                    selected = dos.match_disaggregation(ruptures,q['tlat'],q['tlon'],q['p'],binned=binned)
+                selected = filter_spatial(selected,q['lonmin'],q['lonmax'],q['latmin'],q['latmax'],q['zmin'],q['zmax'])
+                selected = filter_magnitude(selected,q['mmin'],q['mmax'])
+                if q['radius'] is not None:
+                    selected = filter_radius(selected,q['tlat'],q['tlon'],q['radius'])
+                selected = filter_time(selected,q['tmin'],q['tmax'])
+                selected = selected.sort_values('magnitude',ascending=False,kind='mergesort')
+            else:
+                #type and probability
+                tkey = (q['etype'],q['p'] if q['etype']=='stochastic' else None)
+                if tkey not in type_masks:
+                    type_masks[tkey] = ordered.index.isin(filter_type(ordered,q['etype'],q['p']).index)
+                #magnitude range
+                lo = numpy.searchsorted(neg_magnitude,-q['mmax'],side='left')
+                hi = numpy.searchsorted(neg_magnitude,-q['mmin'],side='right')
+                window = slice(lo,hi)
+                mask = (type_masks[tkey][window] & (longitude[window] >= q['lonmin']) & (longitude[window] <= q['lonmax'])
+                        & (latitude[window] >= q['latmin']) & (latitude[window] <= q['latmax'])
+                        & (depth[window] >= q['zmin']) & (depth[window] <= q['zmax']))
+                if q['radius'] is not None:
+                    mask &= eventindex.haversine(q['tlat'],q['tlon'],latitude[window],longitude[window]) <= q['radius']
+                if q['tmin'] is not None or q['tmax'] is not None:
+                    if epoch is None:
+                        epoch = eventindex.epoch_seconds(ordered)
+                    if q['tmin'] is not None:
+                        mask &= epoch[window] >= q['tmin']
+                    if q['tmax'] is not None:
+                        mask &= epoch[window] <= q['tmax']
+                selected = ordered.iloc[lo+numpy.flatnonzero(mask)]
+            if q['num_events'] > 0:
+                selected = selected.iloc[q['offset']:q['offset']+q['num_events']]
+            else:
+                selected = selected.iloc[q['offset']:]
+            results.append(selected)
 
-    #spatial filter
-    selected = filter_spatial(selected,lonmin,lonmax,latmin,latmax,zmin,zmax)
+    #convert to quakeml (or output format)
+    if combined:
+        return ''.join(quakeml.iter_quakeml(results,provider='GFZ'))
+    return [eventformats.encode_events(selected,output_format,compression,provider='GFZ')
+            for selected,(output_format,compression) in zip(results,encodings)]
 
-    #magnitude filter
-    selected = filter_magnitude(selected,mmin,mmax)
+def query_events_iter(db, chunksize=1000, output_format='quakeml', compression=None, **kwargs):
+    '''
+    Same as query_events (takes same keyword arguments) but yields the
+    QuakeML in chunks of at most chunksize events (e.g., for chunked HTTP responses)
+    only (uncompressed) quakeml is streamed
+    '''
+    if output_format != 'quakeml' or compression is not None:
+        raise ValueError('Only (uncompressed) quakeml can be streamed')
+    selected = select_events(db,chunksize=chunksize,**kwargs)
+    return quakeml.iter_quakeml(selected,provider='GFZ',chunksize=chunksize)
 
-    #sort according to magnitude
-    selected= selected.sort_values('magnitude',ascending=False)
+#CACHE
+QUERY_CACHE = querycache.QueryCache()
 
-    #filter according to num_events
-    if (num_events > 0 ):
-        selected = selected.iloc[0:num_events]
+def catalog_version(db):
+    '''
+    returns version of catalog (changes when underlying data changes)
+    '''
+    if isinstance(db,pandas.DataFrame):
+        return db.attrs.get('version',(id(db),len(db)))
+    return db.version
 
-    #convert to quakeml
-    selected=quakeml.events2quakeml(selected,provider='GFZ')
+def normalize_query(**kwargs):
+    '''
+    returns normalized query_events parameters as hashable key
+    (defaults filled in, longitudes converted, unused parameters dropped)
+    '''
+    params = dict((k,v.default) for k,v in inspect.signature(query_events).parameters.items() if k not in ['db','trace'])
+    params.update(kwargs)
+    params.pop('trace',None)
+    for lon in ['lonmin','lonmax']:
+        if params[lon] > 180:
+            params[lon] = convert_360(params[lon])
+    for t in ['tmin','tmax']:
+        params[t] = eventindex.to_epoch(params[t])
+    #target only used for deaggregation and radius, probability not for expert/observed
+    if params['etype'] != 'deaggregation' and params['radius'] is None:
+        params['tlat'] = params['tlon'] = None
+    if params['etype'] in ['expert','observed']:
+        params['p'] = None
+    return tuple(sorted(params.items()))
 
+def query_events_cached(db, cache=None, **kwargs):
+    '''
+    Same as query_events (takes same keyword arguments) but results are cached
+    The cache is invalidated when the catalog or disaggregation files change,
+    after upserts (upsert_events) only queries of changed event types are dropped
+    '''
+    if cache is None:
+        cache = QUERY_CACHE
+    repository_version = dos.get_repository().get_version()
+    def changes(since):
+        #partial invalidation only if the disaggregation files are the same
+        if since[1] != repository_version:
+            return None
+        types = changed_types(db,since[0])
+        if types is None:
+            return None
+        #deaggregation matches stochastic events
+        if 'stochastic' in types:
+            types = types | set(['deaggregation'])
+        return lambda key: dict(key)['etype'] in types
+    version = (catalog_version(db),repository_version)
+    cache.validate(version,changes)
+    key = normalize_query(**kwargs)
+    with querytrace.get_trace(kwargs.get('trace')).stage('cache_lookup'):
+        selected = cache.get(key)
+    if selected is None:
+        selected = query_events(db,**kwargs)
+        #not cached if the catalog changed while the query ran (e.g., upsert_events)
+        cache.put(key,selected,version)
     return selected
 
 
@@ -141,6 +583,10 @@ def main():
     #test writing
     with open('test.xml','w') as f:
         f.write(selected)
+    #or stream it
+    #with open('test.xml','w') as f:
+    #    for chunk in query_events_iter(db,etype=etype):
+    #        f.write(chunk)
 
 if __name__ =='__main__':
     main()
@@ -0,0 +1,520 @@
+#####################################
+# Persistent, indexed event catalog stores
+# (SQLite or memory-mapped columns) with predicates pushed down to the store
+import os
+import json
+import argparse
+import uuid
+import sqlite3
+import threading
+import numpy
+import pandas
+#from . import eventindex
+import eventindex
+#from . import quakeml
+import quakeml
+
+TABLE = 'events'
+#epoch time per event (rowid) for time window queries
+EPOCH_TABLE = 'event_epochs'
+#generation (new store) and version counter (changes of the catalog)
+META_TABLE = 'meta'
+#types of events changed per version (for partial invalidation of cached queries)
+CHANGES_TABLE = 'changes'
+
+def haversine(lat1,lon1,lat2,lon2):
+    '''
+    great circle distance (km) as sql function (NULL for missing locations)
+    '''
+    if lat1 is None or lon1 is None:
+        return None
+    return float(eventindex.haversine(lat1,lon1,lat2,lon2))
+
+def epoch(year,month,day,hour,minute,second):
+    '''
+    time of event (seconds since 1970, as eventindex.epoch_seconds) as sql function,
+    for stores without epoch table
+    '''
+    year,month,day,hour,minute,second = [0 if v is None else v for v in [year,month,day,hour,minute,second]]
+    months = (int(year)-1970)*12+max(int(month),1)-1
+    days = int(numpy.datetime64(months,'M').astype('datetime64[D]').astype('int64'))+max(int(day),1)-1
+    return days*86400+int(hour)*3600+int(minute)*60+float(second)
+
+def has_table(conn,name):
+    return conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",(name,)).fetchone() is not None
+
+def insert_epochs(conn,rowids,catalog):
+    '''
+    adds epochs of catalog stored as rowids
+    '''
+    conn.executemany('INSERT OR REPLACE INTO {} (id, epoch) VALUES (?, ?)'.format(EPOCH_TABLE),
+                     zip(rowids,eventindex.epoch_seconds(catalog).tolist()))
+
+def create_meta(conn):
+    '''
+    creates version counter and change log if not existing
+    '''
+    conn.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value)'.format(META_TABLE))
+    conn.execute('INSERT OR IGNORE INTO {} (key, value) VALUES (?, ?)'.format(META_TABLE),('generation',uuid.uuid4().hex))
+    conn.execute('INSERT OR IGNORE INTO {} (key, value) VALUES (?, ?)'.format(META_TABLE),('version',1))
+    conn.execute('CREATE TABLE IF NOT EXISTS {} (version INTEGER, type TEXT)'.format(CHANGES_TABLE))
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_changes_version ON {} (version)'.format(CHANGES_TABLE))
+
+def read_version(conn):
+    '''
+    returns (generation,counter) or None if the store has no version counter
+    '''
+    if not has_table(conn,META_TABLE):
+        return None
+    meta = dict(conn.execute('SELECT key, value FROM {}'.format(META_TABLE)).fetchall())
+    return (meta['generation'],meta['version'])
+
+def bump_version(conn,types):
+    '''
+    increments version counter and logs changed event types
+    '''
+    conn.execute("UPDATE {} SET value = value+1 WHERE key='version'".format(META_TABLE))
+    version = read_version(conn)[1]
+    conn.executemany('INSERT INTO {} (version, type) VALUES (?, ?)'.format(CHANGES_TABLE),[(version,t) for t in sorted(types)])
+
+class EventStore(object):
+    '''
+    SQLite backed event catalog, filters are evaluated by the store
+    and only matching rows are returned as pandas dataframe
+    '''
+    def __init__(self,filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename,check_same_thread=False)
+        self.conn.create_function('haversine',4,haversine,deterministic=True)
+        self.conn.create_function('epoch',6,epoch,deterministic=True)
+        #one connection shared by all threads of a process
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        '''
+        version of stored catalog: generation and counter of changes (cheap to
+        look up, see upsert) or modification time of file for stores without counter
+        '''
+        with self.lock:
+            version = read_version(self.conn)
+        if version is None:
+            return os.stat(self.filename).st_mtime_ns
+        return version
+
+    def changed_types(self,since):
+        '''
+        returns types of events changed after version since,
+        None if unknown (e.g., other generation or no change log)
+        '''
+        with self.lock:
+            version = read_version(self.conn)
+            if version is None or not isinstance(since,tuple) or since[0] != version[0] or since[1] > version[1]:
+                return None
+            rows = self.conn.execute('SELECT DISTINCT type FROM {} WHERE version > ?'.format(CHANGES_TABLE),(since[1],)).fetchall()
+        return set(r[0] for r in rows)
+
+    def close(self):
+        self.conn.close()
+
+    def _real_columns(self):
+        '''
+        returns columns declared as REAL, needs lock
+        '''
+        info = self.conn.execute('PRAGMA table_info({})'.format(TABLE)).fetchall()
+        return [c[1] for c in info if c[2]=='REAL']
+
+    def _typed(self,selected,real_columns):
+        '''
+        row labels are positions in the imported catalog (as for csv) and
+        REAL columns are float even if a (chunk of the) result has only integers or NULL
+        '''
+        selected.index = selected.index-1
+        selected.index.name = None
+        for column in real_columns:
+            selected[column] = selected[column].astype('float64')
+        #to detect changes of the underlying data
+        selected.attrs['version'] = self.version
+        return selected
+
+    def _query(self,sql,params=()):
+        '''
+        runs query and returns dataframe indexed by catalog row
+        '''
+        with self.lock:
+            selected = pandas.read_sql_query(sql,self.conn,params=params,index_col='rowid')
+            real_columns = self._real_columns()
+        return self._typed(selected,real_columns)
+
+    def _query_iter(self,sql,params=(),chunksize=1000):
+        '''
+        runs query and yields dataframes of at most chunksize rows
+        '''
+        with self.lock:
+            cursor = self.conn.execute(sql,params)
+            columns = [c[0] for c in cursor.description]
+            real_columns = self._real_columns()
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(chunksize)
+            if not rows:
+                break
+            yield self._typed(pandas.DataFrame.from_records(rows,columns=columns,index='rowid'),real_columns)
+
+    def select(self,etype,probability=0,lonmin=-180,lonmax=180,latmin=-90,latmax=90,zmin=0,zmax=999,mmin=0,mmax=12,spatial=True,sort=False,limit=-1,offset=0,chunksize=None,
+               radius=None,tlat=0,tlon=0,tmin=None,tmax=None):
+        '''
+        returns events matching type/probability and, if spatial,
+        location, depth and magnitude range (same semantics as
+        eventquery.filter_type, filter_spatial and filter_magnitude)
+        Optional
+            - sort: sorted by decreasing magnitude (default: catalog order)
+            - limit: maximum number of events (default -1 i.e. all)
+            - offset: number of events to skip (default 0)
+            - chunksize: returns generator of dataframes with chunksize events
+            - radius: maximum distance (km) to tlat/tlon (bounding box on the location index, then haversine)
+            - tmin/tmax: time window (seconds since 1970, index of the epoch table,
+                         computed per event if the store has none, see create_index)
+        '''
+        where = []
+        params = []
+        #type and probability
+        if etype in ['stochastic']:
+            where.append('type = ? AND probability > ?')
+            params += ['stochastic',probability]
+        elif etype in ['deaggregation']:
+            where.append('type = ?')
+            params.append('stochastic')
+        else:
+            where.append('type = ?')
+            params.append(etype)
+        if spatial:
+            where.append('longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?')
+            params += [lonmin,lonmax,latmin,latmax]
+            where.append('depth BETWEEN ? AND ?')
+            params += [zmin,zmax]
+            where.append('magnitude BETWEEN ? AND ?')
+            params += [mmin,mmax]
+            if radius is not None:
+                where.append('longitude BETWEEN ? AND ? AND latitude BETWEEN ? AND ?')
+                params += list(eventindex.bounding_box(tlat,tlon,radius))
+                where.append('haversine(latitude,longitude,?,?) <= ?')
+                params += [tlat,tlon,radius]
+            if tmin is not None or tmax is not None:
+                #queries never write to the store (shared by worker processes)
+                with self.lock:
+                    indexed = has_table(self.conn,EPOCH_TABLE)
+                column = 'epoch' if indexed else 'epoch(year,month,day,hour,minute,second)'
+                epoch = []
+                if tmin is not None:
+                    epoch.append(column+' >= ?')
+                    params.append(tmin)
+                if tmax is not None:
+                    epoch.append(column+' <= ?')
+                    params.append(tmax)
+                if indexed:
+                    where.append('rowid IN (SELECT id FROM {} WHERE {})'.format(EPOCH_TABLE,' AND '.join(epoch)))
+                else:
+                    where += epoch
+        order = 'magnitude DESC, rowid' if sort else 'rowid'
+        sql = 'SELECT rowid, * FROM {} WHERE {} ORDER BY {}'.format(TABLE,' AND '.join(where),order)
+        if limit > 0 or offset > 0:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [limit if limit > 0 else -1,offset]
+        if chunksize:
+            return self._query_iter(sql,params,chunksize)
+        return self._query(sql,params)
+
+    def take(self,labels):
+        '''
+        returns events with given row labels (in that order)
+        '''
+        labels = [int(l) for l in labels]
+        selected = []
+        #bounded number of sql variables per statement
+        for i in range(0,len(labels),500):
+            chunk = labels[i:i+500]
+            sql = 'SELECT rowid, * FROM {} WHERE rowid IN ({})'.format(TABLE,','.join('?'*len(chunk)))
+            selected.append(self._query(sql,[l+1 for l in chunk]))
+        if not selected:
+            return self._query('SELECT rowid, * FROM {} WHERE 0'.format(TABLE))
+        return pandas.concat(selected).loc[labels]
+
+    def create_epochs(self,chunksize=100000):
+        '''
+        creates the (indexed) epoch time of all events if not existing
+        '''
+        with self.lock:
+            if has_table(self.conn,EPOCH_TABLE):
+                return
+            self.conn.execute('CREATE TABLE {} (id INTEGER PRIMARY KEY, epoch REAL)'.format(EPOCH_TABLE))
+            sql = 'SELECT rowid, year, month, day, hour, minute, second FROM {} ORDER BY rowid'.format(TABLE)
+            for chunk in pandas.read_sql_query(sql,self.conn,chunksize=chunksize):
+                insert_epochs(self.conn,chunk.rowid.tolist(),chunk)
+            self.conn.execute('CREATE INDEX idx_epoch ON {} (epoch)'.format(EPOCH_TABLE))
+            self.conn.commit()
+
+    def insert(self,catalog):
+        '''
+        appends a catalog (pandas dataframe) to the store
+        '''
+        with self.lock:
+            first_rowid = 1
+            if has_table(self.conn,TABLE):
+                first_rowid = (self.conn.execute('SELECT max(rowid) FROM {}'.format(TABLE)).fetchone()[0] or 0)+1
+            catalog.to_sql(TABLE,self.conn,if_exists='append',index=False)
+            #keep epochs and version of existing stores up to date
+            if has_table(self.conn,EPOCH_TABLE):
+                insert_epochs(self.conn,range(first_rowid,first_rowid+len(catalog)),catalog)
+            if has_table(self.conn,META_TABLE):
+                bump_version(self.conn,set(catalog['type'].dropna().astype(str)))
+            self.conn.commit()
+
+    def upsert(self,catalog):
+        '''
+        adds events (pandas dataframe), events with an eventID already in the store
+        are updated (columns of catalog, others are kept) and keep their row,
+        new events are appended; increments the version counter
+        The store is written in one transaction through its own connection in WAL mode:
+        queries (of all processes) go on while events are written
+        Returns number of inserted and updated events
+        '''
+        catalog = catalog.drop_duplicates('eventID',keep='last')
+        conn = sqlite3.connect(self.filename,timeout=60)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                if not has_table(conn,TABLE):
+                    catalog.iloc[:0].to_sql(TABLE,conn,index=False)
+                create_meta(conn)
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_eventid ON {} (eventID)'.format(TABLE))
+                stored = [c[1] for c in conn.execute('PRAGMA table_info({})'.format(TABLE)).fetchall()]
+                #columns unknown to the store are dropped
+                columns = [c for c in catalog.columns if c in stored]
+                names = ', '.join('"{}"'.format(c) for c in columns)
+                #staging table with the column types of the store
+                conn.execute('DROP TABLE IF EXISTS temp.upserted')
+                conn.execute('CREATE TEMP TABLE upserted AS SELECT {} FROM {} WHERE 0'.format(names,TABLE))
+                rows = catalog[columns].astype(object).where(catalog[columns].notna(),None).itertuples(index=False,name=None)
+                conn.executemany('INSERT INTO temp.upserted ({}) VALUES ({})'.format(names,', '.join('?'*len(columns))),rows)
+                #events are looked up by eventID per updated row (linear in the feed size)
+                conn.execute('CREATE INDEX temp.idx_upserted_eventid ON upserted (eventID)')
+                #types before the update (events may change their type)
+                types = set(r[0] for r in conn.execute('SELECT DISTINCT type FROM {} WHERE eventID IN (SELECT eventID FROM temp.upserted)'.format(TABLE)))
+                updated = conn.execute('UPDATE {0} SET ({1}) = (SELECT {1} FROM temp.upserted u WHERE u.eventID = {0}.eventID) '
+                                       'WHERE eventID IN (SELECT eventID FROM temp.upserted)'.format(TABLE,names)).rowcount
+                #NOT EXISTS (NOT IN matches nothing once the store has a NULL eventID)
+                inserted = conn.execute('INSERT INTO {0} ({1}) SELECT {1} FROM temp.upserted u '
+                                        'WHERE NOT EXISTS (SELECT 1 FROM {0} e WHERE e.eventID = u.eventID) '
+                                        'ORDER BY u.rowid'.format(TABLE,names)).rowcount
+                if 'type' in columns:
+                    types |= set(r[0] for r in conn.execute('SELECT DISTINCT type FROM temp.upserted'))
+                if has_table(conn,EPOCH_TABLE):
+                    changed = pandas.read_sql_query('SELECT rowid, year, month, day, hour, minute, second FROM {} '
+                                                    'WHERE eventID IN (SELECT eventID FROM temp.upserted)'.format(TABLE),conn)
+                    insert_epochs(conn,changed.rowid.tolist(),changed)
+                bump_version(conn,set(str(t) for t in types if t is not None))
+                conn.execute('DROP TABLE temp.upserted')
+        finally:
+            conn.close()
+        return inserted,updated
+
+    def create_index(self):
+        '''
+        creates the indices used by select
+        '''
+        with self.lock:
+            #also serves sorted top events (ORDER BY magnitude DESC LIMIT)
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_type_magnitude ON {} (type, magnitude)'.format(TABLE))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_type_probability ON {} (type, probability)'.format(TABLE))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_location ON {} (longitude, latitude)'.format(TABLE))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_depth ON {} (depth)'.format(TABLE))
+            #updates by eventID (upsert)
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_eventid ON {} (eventID)'.format(TABLE))
+            create_meta(self.conn)
+            self.conn.commit()
+        self.create_epochs()
+        with self.lock:
+            #statistics for the query planner
+            self.conn.execute('ANALYZE')
+            self.conn.commit()
+
+SCHEMA = 'schema.json'
+#epoch time of the events (derived, not a column of the catalog)
+EPOCH_FILE = 'epoch.npy'
+
+class MappedCatalog(object):
+    '''
+    Catalog stored as one numpy (.npy) file per column and mapped read-only,
+    filter masks are built directly on the mapped arrays and only matching rows
+    are copied into a pandas dataframe
+    All processes mapping the same directory share the memory (page cache)
+    '''
+    def __init__(self,directory):
+        self.directory = directory
+        with open(os.path.join(directory,SCHEMA),'r') as f:
+            self.schema = json.load(f)
+        self.columns = dict((c['name'],numpy.load(os.path.join(directory,c['name']+'.npy'),mmap_mode='r')) for c in self.schema['columns'])
+        #string columns stored as codes
+        self.categories = dict((c['name'],numpy.array(c['categories'],dtype=object)) for c in self.schema['columns'] if 'categories' in c)
+        self.version = os.stat(os.path.join(directory,SCHEMA)).st_mtime_ns
+        #spatio-temporal index, built on first radius/time query
+        self.index = None
+        self.index_lock = threading.Lock()
+
+    def __len__(self):
+        return self.schema['rows']
+
+    def _codes(self,column,value):
+        '''
+        returns code of value in (coded) string column or -2 (matches nothing)
+        '''
+        match = numpy.flatnonzero(self.categories[column]==value)
+        return match[0] if len(match)>0 else -2
+
+    def _column_mask(self,column,value):
+        if column in self.categories:
+            return self.columns[column] == self._codes(column,value)
+        return self.columns[column] == value
+
+    def _frame(self,idx):
+        '''
+        returns rows idx as dataframe (row labels are positions in the catalog)
+        '''
+        data = {}
+        for c in self.schema['columns']:
+            values = self.columns[c['name']][idx]
+            if c['name'] in self.categories:
+                categories = numpy.append(self.categories[c['name']],numpy.nan)
+                #missing values (-1) point to NaN
+                values = categories[values]
+            data[c['name']] = values
+        selected = pandas.DataFrame(data,columns=[c['name'] for c in self.schema['columns']],index=idx)
+        #to detect changes of the underlying data
+        selected.attrs['version'] = self.version
+        return selected
+
+    def take(self,labels):
+        '''
+        returns events with given row labels (in that order)
+        '''
+        return self._frame(numpy.asarray(labels,dtype='int64'))
+
+    def get_index(self):
+        '''
+        returns spatio-temporal index (eventindex.EventIndex) of the catalog,
+        epochs are mapped from epoch.npy if exported
+        '''
+        with self.index_lock:
+            if self.index is None:
+                filename = os.path.join(self.directory,EPOCH_FILE)
+                if os.path.exists(filename):
+                    epoch = numpy.load(filename,mmap_mode='r')
+                else:
+                    epoch = eventindex.epoch_seconds(pandas.DataFrame(dict((c,self.columns[c]) for c in ['year','month','day','hour','minute','second'])))
+                self.index = eventindex.EventIndex(self.columns['longitude'],self.columns['latitude'],epoch)
+            return self.index
+
+    def positions(self,etype,probability=0,lonmin=-180,lonmax=180,latmin=-90,latmax=90,zmin=0,zmax=999,mmin=0,mmax=12,spatial=True,sort=False,limit=-1,offset=0,
+                  radius=None,tlat=0,tlon=0,tmin=None,tmax=None):
+        '''
+        returns positions (row labels) of the events select returns, no rows are copied
+        '''
+        #type and probability
+        if etype in ['stochastic']:
+            mask = self._column_mask('type','stochastic') & (self.columns['probability'] > probability)
+        elif etype in ['deaggregation']:
+            mask = self._column_mask('type','stochastic')
+        else:
+            mask = self._column_mask('type',etype)
+        if spatial:
+            longitude = self.columns['longitude']
+            latitude = self.columns['latitude']
+            depth = self.columns['depth']
+            magnitude = self.columns['magnitude']
+            mask &= (longitude >= lonmin) & (longitude <= lonmax) & (latitude >= latmin) & (latitude <= latmax)
+            mask &= (depth >= zmin) & (depth <= zmax) & (magnitude >= mmin) & (magnitude <= mmax)
+            if radius is not None or tmin is not None or tmax is not None:
+                indexed = numpy.zeros(len(mask),dtype=bool)
+                indexed[self.get_index().select(tlat,tlon,radius,tmin,tmax)] = True
+                mask &= indexed
+        idx = numpy.flatnonzero(mask)
+        if sort:
+            #decreasing magnitude, ties in catalog order
+            idx = idx[numpy.argsort(-self.columns['magnitude'][idx],kind='mergesort')]
+        return idx[offset:offset+limit] if limit > 0 else idx[offset:]
+
+    def select(self,etype,probability=0,lonmin=-180,lonmax=180,latmin=-90,latmax=90,zmin=0,zmax=999,mmin=0,mmax=12,spatial=True,sort=False,limit=-1,offset=0,chunksize=None,
+               radius=None,tlat=0,tlon=0,tmin=None,tmax=None):
+        '''
+        returns events matching type/probability and, if spatial,
+        location, depth, magnitude range, radius and time window (same as EventStore.select)
+        '''
+        idx = self.positions(etype,probability,lonmin,lonmax,latmin,latmax,zmin,zmax,mmin,mmax,spatial,sort,limit,offset,radius,tlat,tlon,tmin,tmax)
+        if chunksize:
+            return (self._frame(idx[i:i+chunksize]) for i in range(0,len(idx),chunksize))
+        return self._frame(idx)
+
+def export_mapped(catalog,directory):
+    '''
+    writes catalog (pandas dataframe) as memory-mappable columns into directory
+    and returns the mapped catalog
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    columns = []
+    for name in catalog.columns:
+        values = catalog[name]
+        column = {'name':name}
+        if pandas.api.types.is_numeric_dtype(values) and not isinstance(values.dtype,pandas.CategoricalDtype):
+            array = values.to_numpy()
+        else:
+            #strings are stored as codes (missing: -1)
+            codes,categories = pandas.factorize(values)
+            array = codes.astype('int32')
+            column['categories'] = [str(c) for c in categories]
+        numpy.save(os.path.join(directory,name+'.npy'),array)
+        columns.append(column)
+    numpy.save(os.path.join(directory,EPOCH_FILE),eventindex.epoch_seconds(catalog))
+    #schema is written last, its modification time is the version
+    with open(os.path.join(directory,SCHEMA),'w') as f:
+        json.dump({'rows':len(catalog),'columns':columns},f)
+    return MappedCatalog(directory)
+
+def import_csv(csvfile,dbfile,chunksize=100000):
+    '''
+    one-off import of a csv catalog (e.g., example_event_db.csv layout)
+    into a new store, returns the store
+    '''
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+    store = EventStore(dbfile)
+    for chunk in pandas.read_csv(csvfile,chunksize=chunksize):
+        store.insert(chunk)
+    store.create_index()
+    return store
+
+def main():
+    parser = argparse.ArgumentParser(description='Imports a csv event catalog into an indexed SQLite store or memory-mapped columns')
+    parser.add_argument('csvfile',help='csv catalog (e.g., example_event_db.csv)')
+    parser.add_argument('dbfile',help='SQLite file (replaced if existing) or directory for mapped columns to create')
+    parser.add_argument('--chunksize',type=int,default=100000,help='rows read per chunk')
+    parser.add_argument('--format',choices=['sqlite','mmap'],default='sqlite',help='store format')
+    parser.add_argument('--upsert',action='store_true',help='adds/updates the events (csv or QuakeML .xml) of an existing SQLite store')
+    args = parser.parse_args()
+    if args.upsert:
+        if args.csvfile.endswith('.xml'):
+            catalog = quakeml.drop_placeholders(quakeml.quakeml2events(args.csvfile))
+        else:
+            catalog = pandas.read_csv(args.csvfile)
+        store = EventStore(args.dbfile)
+        print('{} inserted, {} updated'.format(*store.upsert(catalog)))
+        store.close()
+    elif args.format=='mmap':
+        export_mapped(pandas.read_csv(args.csvfile),args.dbfile)
+    else:
+        store = import_csv(args.csvfile,args.dbfile,args.chunksize)
+        store.close()
+
+if __name__ =='__main__':
+    main()
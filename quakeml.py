@@ -1,6 +1,9 @@
 #####################################
 # Convert quakeml catalogs to pandas
 # and vice versa
+import io
+import re
+import numpy
 import pandas
 import lxml.etree as le
 
@@ -142,6 +145,183 @@ def events2quakeml(catalog,provider='GFZ'):
     #return str(le.tostring(quakeml,pretty_print=True,xml_declaration=True),encoding='utf-8')
     return le.tostring(quakeml,pretty_print=True,encoding='unicode')
 
+#template of a single event as written by events2quakeml (pretty printed)
+EVENT_TEMPLATE = '''  <event publicID="%s">
+    <preferredOriginID>%s</preferredOriginID>
+    <preferredMagnitudeID>%s</preferredMagnitudeID>
+    <type>earthquake</type>
+    <description>
+      <text>%s</text>
+    </description>
+    <origin publicID="%s">
+      <time>
+        <value>%s</value>
+        <uncertainty>%s</uncertainty>
+      </time>
+      <latitude>
+        <value>%s</value>
+        <uncertainty>%s</uncertainty>
+      </latitude>
+      <longitude>
+        <value>%s</value>
+        <uncertainty>%s</uncertainty>
+      </longitude>
+      <depth>
+        <value>%s</value>
+        <uncertainty>%s</uncertainty>
+      </depth>
+      <creationInfo>
+        <value>%s</value>
+      </creationInfo>
+    </origin>
+    <originUncertainty>
+      <horizontalUncertainty>%s</horizontalUncertainty>
+      <minHorizontalUncertainty>%s</minHorizontalUncertainty>
+      <maxHorizontalUncertainty>%s</maxHorizontalUncertainty>
+      <azimuthMaxHorizontalUncertainty>%s</azimuthMaxHorizontalUncertainty>
+    </originUncertainty>
+    <magnitude publicID="%s">
+      <mag>
+        <value>%s</value>
+        <uncertainty>%s</uncertainty>
+      </mag>
+      <type>MW</type>
+      <creationInfo>
+        <value>%s</value>
+      </creationInfo>
+    </magnitude>
+    <focalMechanism publicID="%s">
+      <nodalPlanes>
+        <nodalPlane1>
+          <strike>
+            <value>%s</value>
+            <uncertainty>%s</uncertainty>
+          </strike>
+          <dip>
+            <value>%s</value>
+            <uncertainty>%s</uncertainty>
+          </dip>
+          <rake>
+            <value>%s</value>
+            <uncertainty>%s</uncertainty>
+          </rake>
+        </nodalPlane1>
+        <preferredPlane>nodalPlane1</preferredPlane>
+      </nodalPlanes>
+    </focalMechanism>
+  </event>
+'''
+#same without indentation and line breaks
+COMPACT_EVENT_TEMPLATE = re.sub(r'>\s+<','><',EVENT_TEMPLATE).strip()
+
+def escape_text(text):
+    '''
+    escapes xml text as lxml does
+    '''
+    return text.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;').replace('\r','&#13;')
+
+def escape_attribute(text):
+    '''
+    escapes xml attribute value as lxml does
+    '''
+    return escape_text(text).replace('"','&quot;').replace('\n','&#10;').replace('\t','&#9;')
+
+def format_column(catalog,column,escape=escape_text):
+    '''
+    formats a column of the catalog once as list of strings
+    '''
+    values = catalog[column]
+    if values.dtype=='float32' or values.dtype==pandas.SparseDtype('float32',numpy.nan):
+        #shortest representation of float32 (not of the value widened to float)
+        strings = [str(v) for v in values.to_numpy(dtype='float32')]
+    else:
+        strings = [str(v) for v in values.tolist()]
+    if not pandas.api.types.is_numeric_dtype(values):
+        strings = [escape(v) for v in strings]
+    return strings
+
+def format_utc(catalog):
+    '''
+    given catalog returns list of UTC strings (vectorized event2utc)
+    '''
+    d = catalog[['year','month','day','hour','minute','second']].fillna(0)
+    year = d.year.astype('int64').tolist()
+    month = d.month.clip(lower=1).astype('int64').tolist()
+    day = d.day.clip(lower=1).astype('int64').tolist()
+    hour = d.hour.astype('int64').tolist()
+    minute = d.minute.astype('int64').tolist()
+    second = d.second.astype('float64').tolist()
+    return ['{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:09f}Z'.format(*t) for t in zip(year,month,day,hour,minute,second)]
+
+def format_events(catalog,provider='GFZ',pretty=True):
+    '''
+    Given a pandas dataframe with events returns list with the QuakeML
+    string of each event (columns are formatted once), pretty printed or compact
+    '''
+    n = len(catalog)
+    ids = format_column(catalog,'eventID')
+    id_attrs = format_column(catalog,'eventID',escape_attribute)
+    providers = [escape_text(str(provider))]*n
+    fields = zip(id_attrs,ids,ids,format_column(catalog,'type'),id_attrs,
+                 format_utc(catalog),format_column(catalog,'timeUncertainty'),
+                 format_column(catalog,'latitude'),format_column(catalog,'latitudeUncertainty'),
+                 format_column(catalog,'longitude'),format_column(catalog,'longitudeUncertainty'),
+                 format_column(catalog,'depth'),format_column(catalog,'depthUncertainty'),
+                 providers,
+                 format_column(catalog,'horizontalUncertainty'),format_column(catalog,'minHorizontalUncertainty'),
+                 format_column(catalog,'maxHorizontalUncertainty'),format_column(catalog,'azimuthMaxHorizontalUncertainty'),
+                 id_attrs,format_column(catalog,'magnitude'),format_column(catalog,'magnitudeUncertainty'),
+                 providers,
+                 id_attrs,format_column(catalog,'strike'),format_column(catalog,'strikeUncertainty'),
+                 format_column(catalog,'dip'),format_column(catalog,'dipUncertainty'),
+                 format_column(catalog,'rake'),format_column(catalog,'rakeUncertainty'))
+    template = EVENT_TEMPLATE if pretty else COMPACT_EVENT_TEMPLATE
+    return [template % f for f in fields]
+
+def events2quakeml_bulk(catalog,provider='GFZ',stream=None,pretty=True):
+    '''
+    Given a pandas dataframe with events returns QuakeML version of
+    the catalog, same output as events2quakeml but written in bulk
+    (or without indentation and line breaks if not pretty)
+    If stream (file object) is given the QuakeML is written to it in chunks
+    instead of being returned
+    '''
+    if stream is not None:
+        for chunk in iter_quakeml(catalog,provider,pretty=pretty):
+            stream.write(chunk)
+        return
+    newline = '\n' if pretty else ''
+    xml_namespace = 'http://quakeml.org/xmlns/quakeml/1.2'
+    root = '<eventParameters namespace="{}"'.format(xml_namespace)
+    if len(catalog)==0:
+        return root+'/>'+newline
+    return root+'>'+newline+''.join(format_events(catalog,provider,pretty))+'</eventParameters>'+newline
+
+def iter_quakeml(catalogs,provider='GFZ',chunksize=1000,pretty=True):
+    '''
+    Given a pandas dataframe (or an iterable of dataframes) with events
+    yields the QuakeML in chunks of at most chunksize events,
+    joined chunks are the same as events2quakeml_bulk
+    '''
+    if isinstance(catalogs,pandas.DataFrame):
+        catalogs = [catalogs]
+    newline = '\n' if pretty else ''
+    xml_namespace = 'http://quakeml.org/xmlns/quakeml/1.2'
+    root = '<eventParameters namespace="{}"'.format(xml_namespace)
+    started = False
+    for catalog in catalogs:
+        for i in range(0,len(catalog),chunksize):
+            chunk = ''.join(format_events(catalog.iloc[i:i+chunksize],provider,pretty))
+            #root is opened with the first event
+            if not started:
+                chunk = root+'>'+newline+chunk
+                started = True
+            yield chunk
+    if started:
+        yield '</eventParameters>'+newline
+    else:
+        yield root+'/>'+newline
+
 def get_uncertain_child(parent,childname):
     '''
     Given a childname returns value and uncertainty
@@ -156,61 +336,156 @@ def get_uncertain_child(parent,childname):
         uncertainty = float('NAN')
     return [value,uncertainty]
 
+#catalog columns as read from quakeml and their types
+QUAKEML_COLUMNS=['eventID', 'Agency', 'Identifier', 'year', 'month', 'day', 'hour', 'minute', 'second', 'timeUncertainty', 'longitude', 'longitudeUncertainty', 'latitude', 'latitudeUncertainty','horizontalUncertainty','maxHorizontalUncertainty', 'minHorizontalUncertainty', 'azimuthMaxHorizontalUncertainty', 'depth', 'depthUncertainty', 'magnitude', 'magnitudeUncertainty','rake','rakeUncertainty','dip','dipUncertainty','strike','strikeUncertainty','type', 'probability']
+INT_COLUMNS=['year', 'month', 'day', 'hour', 'minute']
+STR_COLUMNS=['eventID', 'Agency', 'Identifier', 'type']
+#columns not in quakeml (always missing in parsed events)
+PLACEHOLDER_COLUMNS=['Identifier', 'probability']
+
+def open_quakeml(quakemlfile):
+    '''
+    Given a quakeml file name, file object or string returns
+    something lxml can parse incrementally
+    '''
+    if hasattr(quakemlfile,'read'):
+        return quakemlfile
+    if isinstance(quakemlfile,bytes):
+        return io.BytesIO(quakemlfile)
+    if quakemlfile.lstrip().startswith('<'):
+        #already string
+        return io.BytesIO(quakemlfile.encode('utf-8'))
+    return quakemlfile
+
+def find_float(parent,path):
+    '''
+    returns float of text at path or NAN
+    '''
+    try:
+        return float(parent.findtext(path))
+    except (TypeError,ValueError):
+        return float('NAN')
+
+def find_preferred(event,tag,preferred):
+    '''
+    returns child (e.g., origin) referenced by preferred ID or the first one
+    '''
+    pid = event.findtext(preferred)
+    if pid is not None:
+        for child in event.iterfind(tag):
+            if child.get('publicID')==pid:
+                return child
+    return event.find(tag)
+
+def parse_event(event,columns):
+    '''
+    appends values of single event element to lists of columns
+    '''
+    columns['eventID'].append(event.get('publicID'))
+    columns['Identifier'].append(float('NAN'))
+    columns['type'].append(event.findtext('{*}description/{*}text'))
+    columns['probability'].append(float('NAN'))
+    #origin
+    origin = find_preferred(event,'{*}origin','{*}preferredOriginID')
+    if origin is None:
+        origin = le.Element('origin')
+    utc = origin.findtext('{*}time/{*}value')
+    time = utc2event(utc) if utc else [0,1,1,0,0,float('NAN')]
+    for name,value in zip(['year','month','day','hour','minute','second'],time):
+        columns[name].append(value)
+    columns['timeUncertainty'].append(find_float(origin,'{*}time/{*}uncertainty'))
+    for name in ['latitude','longitude','depth']:
+        columns[name].append(find_float(origin,'{*}'+name+'/{*}value'))
+        columns[name+'Uncertainty'].append(find_float(origin,'{*}'+name+'/{*}uncertainty'))
+    #agency/provider
+    agency = origin.findtext('{*}creationInfo/{*}value')
+    if agency is None:
+        agency = origin.findtext('{*}creationInfo/{*}agencyID')
+    columns['Agency'].append(agency)
+    #originUncertainty
+    originUncertainty = event.find('{*}originUncertainty')
+    if originUncertainty is None:
+        originUncertainty = origin.find('{*}originUncertainty')
+    if originUncertainty is None:
+        originUncertainty = le.Element('originUncertainty')
+    for name in ['horizontalUncertainty','minHorizontalUncertainty','maxHorizontalUncertainty','azimuthMaxHorizontalUncertainty']:
+        columns[name].append(find_float(originUncertainty,'{*}'+name))
+    #magnitude
+    magnitude = find_preferred(event,'{*}magnitude','{*}preferredMagnitudeID')
+    if magnitude is None:
+        magnitude = le.Element('magnitude')
+    columns['magnitude'].append(find_float(magnitude,'{*}mag/{*}value'))
+    columns['magnitudeUncertainty'].append(find_float(magnitude,'{*}mag/{*}uncertainty'))
+    #plane
+    nodalPlanes = event.find('{*}focalMechanism/{*}nodalPlanes')
+    if nodalPlanes is None:
+        nodalPlanes = le.Element('nodalPlanes')
+    preferredPlane = nodalPlanes.findtext('{*}preferredPlane') or 'nodalPlane1'
+    preferredPlane = nodalPlanes.find('{*}'+preferredPlane)
+    if preferredPlane is None:
+        preferredPlane = le.Element('nodalPlane1')
+    for name in ['strike','dip','rake']:
+        columns[name].append(find_float(preferredPlane,'{*}'+name+'/{*}value'))
+        columns[name+'Uncertainty'].append(find_float(preferredPlane,'{*}'+name+'/{*}uncertainty'))
+
+def columns2catalog(columns,start=0):
+    '''
+    builds typed catalog (pandas dataframe) from lists of columns
+    '''
+    n = len(columns['eventID'])
+    data = {}
+    for name in QUAKEML_COLUMNS:
+        if name in STR_COLUMNS:
+            data[name] = numpy.array(columns[name],dtype=object)
+        elif name in INT_COLUMNS:
+            data[name] = numpy.array(columns[name],dtype='int64')
+        else:
+            data[name] = numpy.array(columns[name],dtype='float64')
+    return pandas.DataFrame(data,columns=QUAKEML_COLUMNS,index=pandas.RangeIndex(start,start+n))
+
+def read_quakeml(quakemlfile,chunksize=None):
+    '''
+    Given a quakeml file (name or file object) or string returns a pandas dataframe
+    Events are parsed incrementally (iterparse), if chunksize is given
+    returns generator of dataframes with chunksize events instead
+    '''
+    chunks = iter_quakeml_events(quakemlfile,chunksize or 100000)
+    if chunksize:
+        return chunks
+    catalogs = list(chunks)
+    if len(catalogs)==1:
+        return catalogs[0]
+    return pandas.concat(catalogs)
+
+def iter_quakeml_events(quakemlfile,chunksize):
+    '''
+    yields dataframes with chunksize events of the quakeml file/or string
+    '''
+    columns = dict((name,[]) for name in QUAKEML_COLUMNS)
+    start = 0
+    for _,event in le.iterparse(open_quakeml(quakemlfile),events=('end',),tag='{*}event'):
+        parse_event(event,columns)
+        #free parsed elements
+        event.clear()
+        while event.getprevious() is not None:
+            del event.getparent()[0]
+        if len(columns['eventID'])==chunksize:
+            yield columns2catalog(columns,start)
+            start += chunksize
+            columns = dict((name,[]) for name in QUAKEML_COLUMNS)
+    if len(columns['eventID'])>0 or start==0:
+        yield columns2catalog(columns,start)
+
 def quakeml2events(quakemlfile,provider='GFZ'):
     '''
     Given a quakeml file/or string returns a pandas dataframe
     '''
-    #TODO: add uncertainty
-    try:
-        #read quakeml catalog
-        with open(quakemlfile,'r') as f:
-            quakeml = f.read()
-    except:
-        #maybe already string
-        quakeml = quakemlfile
-
-    quakeml = le.fromstring(quakeml)
-    #initialize catalog
-    index = [i for i in range(len(quakeml))]
-    columns=['eventID', 'Agency', 'Identifier', 'year', 'month', 'day', 'hour', 'minute', 'second', 'timeUncertainty', 'longitude', 'longitudeUncertainty', 'latitude', 'latitudeUncertainty','horizontalUncertainty','maxHorizontalUncertainty', 'minHorizontalUncertainty', 'azimuthMaxHorizontalUncertainty', 'depth', 'depthUncertainty', 'magnitude', 'magnitudeUncertainty','rake','rakeUncertainty','dip','dipUncertainty','strike','strikeUncertainty','type', 'probability']
-    catalog=pandas.DataFrame(index=index,columns=columns)
-    #add individual events to catalog
-    for i,event in enumerate(quakeml):
-        #get ID
-        catalog.iloc[i].eventID = event.attrib['publicID']
-        #type
-        catalog.iloc[i].type = event.find('description').findtext('text')
-        #origin
-        origin = event.find('origin')
-        #time
-        catalog.iloc[i].year,catalog.iloc[i].month,catalog.iloc[i].day,catalog.iloc[i].hour,catalog.iloc[i].minute,catalog.iloc[i].second = utc2event(origin.find('time').findtext('value'))
-        catalog.iloc[i].timeUncertainty = float(origin.find('time').findtext('uncertainty'))
-        #latitude/longitude/depth
-        catalog.iloc[i].latitude, catalog.iloc[i].latitudeUncertainty = get_uncertain_child(origin,'latitude')
-        catalog.iloc[i].longitude, catalog.iloc[i].longitudeUncertainty = get_uncertain_child(origin,'longitude')
-        catalog.iloc[i].depth, catalog.iloc[i].depthUncertainty = get_uncertain_child(origin,'depth')
-        #agency/provider
-        catalog.iloc[i].agency = origin.find('creationInfo').findtext('value')
-        #magnitude
-        magnitude = event.find('magnitude')
-        catalog.iloc[i].magnitude, catalog.iloc[i].magnitudeUncertainty = get_uncertain_child(magnitude,'mag')
-        #originUncertainty
-        originUncertainty = event.find('originUncertainty')
-        catalog.iloc[i].horizontalUncertainty = originUncertainty.find('horizontalUncertainty').findtext('value')
-        catalog.iloc[i].minHorizontalUncertainty = originUncertainty.find('minHorizontalUncertainty').findtext('value')
-        catalog.iloc[i].maxHorizontalUncertainty = originUncertainty.find('maxHorizontalUncertainty').findtext('value')
-        catalog.iloc[i].horizontalUncertainty = originUncertainty.find('azimuthMaxHorizontalUncertainty').findtext('value')
-
-        #plane
-        nodalPlanes = event.find('focalMechanism').find('nodalPlanes')
-        preferredPlane = nodalPlanes.findtext('preferredPlane')
-        preferredPlane = nodalPlanes.find(preferredPlane)
-        #GET uncertain child!!
-        catalog.iloc[i].strike,catalog.iloc[i].strikeUncertainty =get_uncertain_child(preferredPlane,'strike')
-        catalog.iloc[i].dip   ,catalog.iloc[i].dipUncertainty  = get_uncertain_child(preferredPlane,'dip')
-        catalog.iloc[i].rake  ,catalog.iloc[i].rakeUncertainty = get_uncertain_child(preferredPlane,'rake')
-        #catalog.iloc[i].strike = float(nodalPlanes.find(preferredPlane).find('strike').findtext('value'))
-        #catalog.iloc[i].dip = float(nodalPlanes.find(preferredPlane).find('dip').findtext('value'))
-        #catalog.iloc[i].rake = float(nodalPlanes.find(preferredPlane).find('rake').findtext('value'))
-
-    return catalog
+    return read_quakeml(quakemlfile)
+
+def drop_placeholders(catalog):
+    '''
+    Given events read from quakeml returns them without the columns quakeml cannot
+    supply (PLACEHOLDER_COLUMNS and columns missing for all events),
+    e.g., to update stored events without overwriting these columns
+    '''
+    return catalog.drop(columns=[c for c in catalog.columns if c != 'eventID' and (c in PLACEHOLDER_COLUMNS or catalog[c].isna().all())])
@@ -0,0 +1,83 @@
+#####################################
+# Cache of serialized query results
+import time
+import threading
+import collections
+
+class QueryCache(object):
+    '''
+    LRU cache of query results with size (maxsize entries) and
+    age (ttl seconds, None: no expiry) bounds
+    Entries are dropped as soon as the version of the underlying data changes
+    (only the entries affected by the change if it is known, see validate)
+    '''
+    def __init__(self,maxsize=256,ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def validate(self,version,changes=None):
+        '''
+        drops entries if version of underlying data changed:
+        changes (optional) is called with the previous version and returns a predicate
+        of the keys affected by the changes since (or None if unknown, all entries are dropped)
+        '''
+        with self.lock:
+            if version != self.version:
+                affected = None
+                if changes is not None and self.version is not None:
+                    affected = changes(self.version)
+                if affected is None:
+                    self.entries.clear()
+                else:
+                    for key in [key for key in self.entries if affected(key)]:
+                        del self.entries[key]
+                self.version = version
+
+    def get(self,key):
+        '''
+        returns cached value or None
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time()-entry[0] > self.ttl:
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self,key,value,version=None):
+        '''
+        adds value to cache, evicts least recently used if full
+        version (optional): version of the data value was computed from (as validated),
+        value is not added if the cache moved to another version meanwhile
+        '''
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.entries[key] = (time.time(),value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''
+        returns hit/miss counters
+        '''
+        with self.lock:
+            return {'hits':self.hits,'misses':self.misses,'evictions':self.evictions,'size':len(self.entries)}
@@ -0,0 +1,244 @@
+#####################################
+# Optional per-stage instrumentation of queries
+# (wall time, rows in/out and allocated memory per stage,
+# cProfile/tracemalloc dumps and Prometheus style metrics)
+import time
+import logging
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+logger = logging.getLogger('quakeledger.query')
+
+class Stage(object):
+    '''
+    measurements of one stage of a query, rows_out is set by the stage
+    '''
+    def __init__(self,trace,name,rows_in=None):
+        self.trace = trace
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = None
+        #bytes allocated (still held at the end) and peak during stage, if memory is traced
+        self.allocated = None
+        self.peak = None
+
+    def __enter__(self):
+        if self.trace.memory:
+            tracemalloc.reset_peak()
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.seconds = time.perf_counter()-self.start
+        if self.trace.memory:
+            current,peak = tracemalloc.get_traced_memory()
+            self.allocated = current-self.start_memory
+            self.peak = peak-self.start_memory
+        self.trace.stages.append(self)
+        return False
+
+    def as_dict(self):
+        return {'stage':self.name,'seconds':self.seconds,'rows_in':self.rows_in,'rows_out':self.rows_out,
+                'allocated':self.allocated,'peak':self.peak}
+
+class QueryTrace(object):
+    '''
+    Trace of a query (pass as trace to eventquery.query_events), records the stages
+    (filters, deaggregation file I/O, binning and matching, sort, serialization)
+    Optional
+        - memory: bytes allocated per stage (tracemalloc), if a file name
+                  the tracemalloc snapshot at the end of the query is dumped to it
+        - profile: cProfile of the query, dumped to file name (or kept as stats if True)
+        - hooks: callables called with the trace at the end of the query (e.g., QueryMetrics, log_trace)
+    '''
+    def __init__(self,memory=False,profile=None,hooks=()):
+        self.memory = bool(memory)
+        self.snapshot_filename = memory if isinstance(memory,str) else None
+        self.profile = profile
+        self.hooks = list(hooks)
+        self.stages = []
+        self.seconds = None
+        self.stats = None
+
+    def stage(self,name,rows_in=None):
+        '''
+        returns context measuring a stage
+        '''
+        return Stage(self,name,rows_in)
+
+    def query(self):
+        '''
+        returns context measuring the whole query
+        '''
+        return QueryContext(self)
+
+    def as_dict(self):
+        '''
+        returns total wall time and stages (e.g., for json)
+        '''
+        return {'seconds':self.seconds,'stages':[stage.as_dict() for stage in self.stages]}
+
+    def __str__(self):
+        lines = ['{:<24s} {:>10s} {:>10s} {:>10s} {:>12s}'.format('stage','seconds','rows_in','rows_out','allocated')]
+        for stage in self.stages:
+            lines.append('{:<24s} {:10.4f} {:>10} {:>10} {:>12}'.format(stage.name,stage.seconds,
+                         '' if stage.rows_in is None else stage.rows_in,'' if stage.rows_out is None else stage.rows_out,
+                         '' if stage.allocated is None else stage.allocated))
+        if self.seconds is not None:
+            lines.append('{:<24s} {:10.4f}'.format('total',self.seconds))
+        return '\n'.join(lines)
+
+class QueryContext(object):
+    '''
+    starts/stops profiling and memory tracing around a query and calls the hooks
+    '''
+    def __init__(self,trace):
+        self.trace = trace
+
+    def __enter__(self):
+        trace = self.trace
+        self.started_tracing = trace.memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.profiler = None
+        if trace.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return trace
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        trace = self.trace
+        trace.seconds = time.perf_counter()-self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            if isinstance(trace.profile,str):
+                self.profiler.dump_stats(trace.profile)
+            else:
+                trace.stats = pstats.Stats(self.profiler)
+        if trace.snapshot_filename is not None:
+            tracemalloc.take_snapshot().dump(trace.snapshot_filename)
+        if self.started_tracing:
+            tracemalloc.stop()
+        if exc_type is None:
+            for hook in trace.hooks:
+                hook(trace)
+        return False
+
+class NullContext(object):
+    '''
+    context/stage doing nothing (tracing disabled)
+    '''
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        return False
+
+    def __setattr__(self,name,value):
+        pass
+
+class NullTrace(object):
+    '''
+    trace used if tracing is disabled, stages cost one call and no measurements
+    '''
+    context = NullContext()
+
+    def stage(self,name,rows_in=None):
+        return self.context
+
+    def query(self):
+        return self.context
+
+NULL_TRACE = NullTrace()
+
+def get_trace(trace):
+    '''
+    returns trace or the disabled trace if None
+    '''
+    return NULL_TRACE if trace is None else trace
+
+def log_trace(trace):
+    '''
+    hook logging the stages of a query (logger quakeledger.query, level DEBUG)
+    '''
+    if logger.isEnabledFor(logging.DEBUG):
+        for stage in trace.stages:
+            logger.debug('stage %s: %.6fs rows %s -> %s allocated %s',stage.name,stage.seconds,stage.rows_in,stage.rows_out,stage.allocated)
+        logger.debug('query: %.6fs',trace.seconds)
+
+#upper bounds (seconds) of the duration histograms
+BUCKETS = (0.001,0.005,0.01,0.05,0.1,0.5,1.,5.,10.,float('inf'))
+
+class QueryMetrics(object):
+    '''
+    hook aggregating traces as Prometheus style metrics:
+    counters of queries, stage calls and rows and histograms of durations,
+    exposition returns them in the Prometheus text format
+    '''
+    def __init__(self,prefix='quakeledger',buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.query_seconds = self._histogram()
+        #per stage
+        self.stage_seconds = {}
+        self.stage_rows = {}
+
+    def _histogram(self):
+        return {'counts':[0]*len(self.buckets),'sum':0.,'count':0}
+
+    def _observe(self,histogram,value):
+        for i,bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram['counts'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def __call__(self,trace):
+        with self.lock:
+            self.queries += 1
+            if trace.seconds is not None:
+                self._observe(self.query_seconds,trace.seconds)
+            for stage in trace.stages:
+                if stage.name not in self.stage_seconds:
+                    self.stage_seconds[stage.name] = self._histogram()
+                    self.stage_rows[stage.name] = [0,0]
+                self._observe(self.stage_seconds[stage.name],stage.seconds)
+                self.stage_rows[stage.name][0] += stage.rows_in or 0
+                self.stage_rows[stage.name][1] += stage.rows_out or 0
+
+    def _exposition_histogram(self,name,histogram,labels=''):
+        lines = []
+        for bound,count in zip(self.buckets,histogram['counts']):
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name,labels,le,count))
+        suffix = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+        lines.append('{}_sum{} {}'.format(name,suffix,histogram['sum']))
+        lines.append('{}_count{} {}'.format(name,suffix,histogram['count']))
+        return lines
+
+    def exposition(self):
+        '''
+        returns metrics in the Prometheus text format
+        '''
+        p = self.prefix
+        with self.lock:
+            lines = ['# TYPE {}_queries_total counter'.format(p),'{}_queries_total {}'.format(p,self.queries),
+                     '# TYPE {}_query_seconds histogram'.format(p)]
+            lines += self._exposition_histogram(p+'_query_seconds',self.query_seconds)
+            lines.append('# TYPE {}_query_stage_seconds histogram'.format(p))
+            for name in sorted(self.stage_seconds):
+                lines += self._exposition_histogram(p+'_query_stage_seconds',self.stage_seconds[name],'stage="{}",'.format(name))
+            for i,direction in enumerate(['in','out']):
+                lines.append('# TYPE {}_query_stage_rows_{}_total counter'.format(p,direction))
+                for name in sorted(self.stage_rows):
+                    lines.append('{}_query_stage_rows_{}_total{{stage="{}"}} {}'.format(p,direction,name,self.stage_rows[name][i]))
+        return '\n'.join(lines)+'\n'
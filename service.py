@@ -0,0 +1,241 @@
+#####################################
+# Asynchronous HTTP (ASGI) front end for eventquery.query_events
+# serve with: python service.py (requires an ASGI server, uvicorn)
+import asyncio
+import inspect
+import urllib.parse
+import concurrent.futures
+#from . import eventquery
+import eventquery
+#from . import eventformats
+import eventformats
+#from . import querytrace
+import querytrace
+#from . import quakeml
+import quakeml
+#from . import eventindex
+import eventindex
+
+#query parameters and their types (query_events)
+PARAMETERS = dict((k,float) for k in inspect.signature(eventquery.query_events).parameters if k not in ['db','association','trace'])
+PARAMETERS.update({'num_events':int,'offset':int,'etype':str,'tmin':eventindex.to_epoch,'tmax':eventindex.to_epoch,'output_format':str,'compression':str})
+CONTENT_TYPE = b'application/xml; charset=utf-8'
+METRICS_CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+#bytes per body message of the response
+CHUNKSIZE = 65536
+
+class StreamInterrupted(Exception):
+    '''
+    streamed response failed after the headers were sent, it cannot be answered
+    with an error status (the server drops the connection)
+    '''
+
+def parse_query(query_string):
+    '''
+    given query string returns keyword arguments for query_events and if response
+    should be streamed (stream=true), raises ValueError for unknown/invalid parameters
+    '''
+    kwargs = {}
+    stream = False
+    for name,value in urllib.parse.parse_qsl(query_string):
+        if name == 'stream':
+            stream = value.lower() in ['1','true','yes']
+        elif name in PARAMETERS:
+            kwargs[name] = PARAMETERS[name](value)
+        else:
+            raise ValueError('Unknown parameter: {}'.format(name))
+    if kwargs.get('etype','stochastic') not in eventquery.ETYPES:
+        raise ValueError('Unknown event type: {} (one of {})'.format(kwargs['etype'],', '.join(eventquery.ETYPES)))
+    if kwargs.get('output_format','quakeml') not in eventformats.FORMATS:
+        raise ValueError('Unknown output format: {}'.format(kwargs['output_format']))
+    if kwargs.get('compression') not in eventformats.COMPRESSIONS:
+        raise ValueError('Unknown compression: {}'.format(kwargs['compression']))
+    if stream and (kwargs.get('output_format','quakeml') != 'quakeml' or kwargs.get('compression') is not None):
+        raise ValueError('stream is only supported for (uncompressed) quakeml')
+    return kwargs,stream
+
+class QueryService(object):
+    '''
+    ASGI application answering GET /events?<query_events parameters>
+    (output_format selects the encoding, compression=gzip compresses the body)
+    Queries run in a bounded thread pool, identical queries in flight are
+    computed once (coalesced) and responses are sent in chunks
+    With stream=true the QuakeML is produced and sent chunk by chunk (not coalesced)
+    If metrics (querytrace.QueryMetrics) are given queries are traced and
+    GET /metrics returns them in the Prometheus text format
+    With ingest POST /events adds the events of the QuakeML body (eventquery.upsert_events),
+    queries in flight finish on the catalog they started with
+    '''
+    def __init__(self,db,max_workers=4,cache=None,association=None,metrics=None,ingest=False):
+        self.db = db
+        self.ingest = ingest
+        #one upsert at a time
+        self.ingest_lock = asyncio.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.cache = cache
+        self.association = association
+        self.metrics = metrics
+        #normalized query -> future of QuakeML
+        self.inflight = {}
+
+    def query(self,kwargs):
+        if self.metrics is not None:
+            kwargs = dict(kwargs,trace=querytrace.QueryTrace(hooks=[self.metrics]))
+        if self.cache is not None:
+            return eventquery.query_events_cached(self.db,cache=self.cache,association=self.association,**kwargs)
+        return eventquery.query_events(self.db,association=self.association,**kwargs)
+
+    async def coalesced(self,kwargs):
+        '''
+        returns result (QuakeML or other output format), computed once for identical queries in flight
+        '''
+        key = eventquery.normalize_query(**kwargs)
+        future = self.inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(loop.run_in_executor(self.executor,self.query,kwargs))
+            self.inflight[key] = future
+            future.add_done_callback(lambda f: self.inflight.pop(key,None))
+        return await asyncio.shield(future)
+
+    async def stream(self,kwargs,send):
+        '''
+        sends QuakeML while it is produced, raises StreamInterrupted
+        if it fails after the headers were sent
+        '''
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(self.executor,lambda: eventquery.query_events_iter(self.db,association=self.association,**kwargs))
+        done = object()
+        #first chunk before the headers: failing queries are still answered with an error status
+        chunk = await loop.run_in_executor(self.executor,next,chunks,done)
+        await send({'type':'http.response.start','status':200,'headers':[(b'content-type',CONTENT_TYPE)]})
+        try:
+            while chunk is not done:
+                await send({'type':'http.response.body','body':chunk.encode('utf-8'),'more_body':True})
+                chunk = await loop.run_in_executor(self.executor,next,chunks,done)
+        except Exception as e:
+            raise StreamInterrupted(str(e)) from e
+        await send({'type':'http.response.body','body':b''})
+
+    async def upsert(self,receive):
+        '''
+        adds events of the (QuakeML) request body, returns number of events
+        '''
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body',b''))
+            more_body = message.get('more_body',False)
+        body = b''.join(body)
+        loop = asyncio.get_running_loop()
+        async with self.ingest_lock:
+            events = await loop.run_in_executor(self.executor,lambda: quakeml.drop_placeholders(quakeml.quakeml2events(body)))
+            #in-memory catalogs are replaced, stores are updated in place
+            self.db = await loop.run_in_executor(self.executor,eventquery.upsert_events,self.db,events)
+        return len(events.drop_duplicates('eventID'))
+
+    async def __call__(self,scope,receive,send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type':'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type':'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+        if scope['path'].rstrip('/') == '/metrics' and self.metrics is not None:
+            await respond(send,200,self.metrics.exposition().encode('utf-8'),METRICS_CONTENT_TYPE)
+            return
+        if scope['path'].rstrip('/') == '/events' and scope['method'] == 'POST' and self.ingest:
+            try:
+                count = await self.upsert(receive)
+            except Exception as e:
+                await respond(send,400,'{}\n'.format(e).encode('utf-8'))
+                return
+            await respond(send,200,'{} events\n'.format(count).encode('utf-8'))
+            return
+        if scope['path'].rstrip('/') != '/events' or scope['method'] not in ['GET','HEAD']:
+            await respond(send,404,b'Not found\n')
+            return
+        try:
+            kwargs,stream = parse_query(scope.get('query_string',b'').decode('utf-8'))
+        except ValueError as e:
+            await respond(send,400,'{}\n'.format(e).encode('utf-8'))
+            return
+        try:
+            if stream:
+                await self.stream(kwargs,send)
+                return
+            body = await self.coalesced(kwargs)
+        except StreamInterrupted:
+            raise
+        except Exception as e:
+            await respond(send,500,'{}\n'.format(e).encode('utf-8'))
+            return
+        if isinstance(body,str):
+            body = body.encode('utf-8')
+        headers = [(b'content-type',eventformats.content_type(kwargs.get('output_format','quakeml')).encode('ascii')),
+                   (b'content-length',str(len(body)).encode('ascii'))]
+        if kwargs.get('compression') == 'gzip':
+            headers.append((b'content-encoding',b'gzip'))
+        await send({'type':'http.response.start','status':200,'headers':headers})
+        for i in range(0,len(body),CHUNKSIZE):
+            await send({'type':'http.response.body','body':body[i:i+CHUNKSIZE],'more_body':i+CHUNKSIZE < len(body)})
+        if len(body) == 0:
+            await send({'type':'http.response.body','body':b''})
+
+async def respond(send,status,body,content_type=b'text/plain; charset=utf-8'):
+    '''
+    sends (plain text) response
+    '''
+    await send({'type':'http.response.start','status':status,'headers':[(b'content-type',content_type)]})
+    await send({'type':'http.response.body','body':body})
+
+async def request(app,path,query_string='',method='GET',body=b''):
+    '''
+    in-process client (no server needed), returns status, headers and body of the response
+    '''
+    scope = {'type':'http','method':method,'path':path,'query_string':query_string.encode('utf-8'),'headers':[]}
+    response = {'status':None,'headers':[],'body':[]}
+    async def receive():
+        return {'type':'http.request','body':body,'more_body':False}
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = message.get('headers',[])
+        else:
+            response['body'].append(message.get('body',b''))
+    await app(scope,receive,send)
+    return response['status'],response['headers'],b''.join(response['body'])
+
+def create_app(provider='GFZ',storage='csv',max_workers=4,metrics=False,ingest=False):
+    '''
+    returns service connected to catalog (see eventquery.connect),
+    with metrics queries are traced (GET /metrics),
+    with ingest events can be added (POST /events)
+    '''
+    return QueryService(eventquery.connect(provider,storage),max_workers=max_workers,cache=eventquery.QUERY_CACHE,
+                        metrics=querytrace.QueryMetrics() if metrics else None,ingest=ingest)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Serves query_events over HTTP')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8000)
+    parser.add_argument('--storage',default='csv',choices=['csv','sqlite','mmap'])
+    parser.add_argument('--workers',type=int,default=4,help='threads for filtering/serialization')
+    parser.add_argument('--metrics',action='store_true',help='traces queries, served at /metrics')
+    parser.add_argument('--ingest',action='store_true',help='accepts QuakeML events (POST /events)')
+    args = parser.parse_args()
+    try:
+        import uvicorn
+    except ImportError:
+        raise Exception('Serving requires an ASGI server, e.g. pip install uvicorn')
+    uvicorn.run(create_app(storage=args.storage,max_workers=args.workers,metrics=args.metrics,ingest=args.ingest),host=args.host,port=args.port)
+
+if __name__ =='__main__':
+    main()